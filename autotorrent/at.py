@@ -1,15 +1,16 @@
 from __future__ import division, unicode_literals
 
 import os
-import hashlib
 import logging
 import platform
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
-from .bencode import bencode, bdecode
 from .humanize import humanize_bytes
-from .utils import is_unsplitable, get_root_of_unsplitable, Pieces
+from .rewrite import rewrite_file
+from .torrent import Torrent, TorrentFile, get_info_hash
+from .utils import is_unsplitable, get_root_of_unsplitable, Pieces, PieceCache
 
 logger = logging.getLogger('autotorrent')
 
@@ -45,8 +46,6 @@ status_messages = {
   Status.FAILED_TO_ADD_TO_CLIENT: '%sFailed%s' % (COLOR_FAILED_TO_ADD_TO_CLIENT, Color.ENDC),
 }
 
-CHUNK_SIZE = 65536
-
 class UnknownLinkTypeException(Exception):
     pass
 
@@ -54,7 +53,15 @@ class IllegalPathException(Exception):
     pass
 
 class AutoTorrent(object):
-    def __init__(self, db, client, store_path, add_limit_size, add_limit_percent, delete_torrents, link_type='soft'):
+    def __init__(self, db, client, store_path, add_limit_size, add_limit_percent, delete_torrents, link_type='soft',
+                 hash_workers=4, piece_cache_path=None, sparse_rewrites=True, verify_ratio=0, verify_budget=0):
+        """
+        hash_workers is the number of threads reading and hashing pieces when hash checking files.
+        piece_cache_path is where hashes of pieces read are cached, None disables the cache.
+        sparse_rewrites leaves the bytes added to rewritten files as holes instead of writing zeros.
+        verify_ratio is the part of the pieces of found files that are checked before they are linked, 0 disables it.
+        verify_budget is the max number of bytes read to verify files by this instance, 0 is no limit.
+        """
         self.db = db
         self.client = client
         self.store_path = store_path
@@ -62,7 +69,15 @@ class AutoTorrent(object):
         self.add_limit_percent = add_limit_percent
         self.delete_torrents = delete_torrents
         self.link_type = link_type
+        self.hash_workers = hash_workers
+        self.piece_cache_path = piece_cache_path
+        self.sparse_rewrites = sparse_rewrites
+        self.verify_ratio = verify_ratio
+        self.verify_budget = verify_budget
+        self.verified_bytes = 0
         self.torrents_seeded = set()
+        self._hash_executor = None
+        self._piece_cache = None
 
     def try_decode(self, value):
         try:
@@ -88,14 +103,55 @@ class AutoTorrent(object):
         """
         Creates the info hash of a torrent
         """
-        return hashlib.sha1(bencode(torrent[b'info'])).hexdigest()
+        return get_info_hash(torrent)
+
+    def get_pieces(self, torrent):
+        """
+        Returns a Pieces for torrent, hashing with the hash workers and the piece cache.
+        """
+        if self.piece_cache_path and self._piece_cache is None:
+            self._piece_cache = PieceCache(self.piece_cache_path)
+        
+        if self.hash_workers <= 1:
+            return Pieces(torrent, cache=self._piece_cache)
+        
+        if self._hash_executor is None:
+            self._hash_executor = ThreadPoolExecutor(max_workers=self.hash_workers)
+        return Pieces(torrent, self._hash_executor, self.hash_workers * 2, self._piece_cache)
+
+    def rank_hash_candidates(self, f, file_paths):
+        """
+        Removes duplicates, also files linked to each other, and files that are gone from
+        the files that can be hash checked against torrent file f.
+        
+        Returns the paths with the closest sizes first, files with the same name first among equals.
+        """
+        name = self.db.normalize_filename(f['path'][-1])
+        seen = set()
+        candidates = []
+        for file_path in file_paths:
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                logger.debug('File %s does not exist anymore, skipping', file_path)
+                continue
+            
+            if (st.st_dev, st.st_ino) in seen:
+                logger.debug('File %s already checked, skipping', file_path)
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            
+            same_name = self.db.normalize_filename(os.path.basename(file_path)) == name
+            candidates.append((abs(st.st_size - f['length']), not same_name, len(candidates), file_path))
+        
+        return [candidate[-1] for candidate in sorted(candidates)]
 
     def find_hash_checks(self, torrent, result):
         """
         Uses hash checking to find pieces
         """
         modified_result = False
-        pieces = Pieces(torrent)
+        pieces = self.get_pieces(torrent)
 
         if self.db.hash_slow_mode:
             logger.info('Slow mode enabled, building hash size table')
@@ -129,14 +185,14 @@ class AutoTorrent(object):
 
             logger.debug('Found %i files to check for matching hash' % len(files_to_check))
 
-            checked_files = set()
-            for db_file in files_to_check:
-                if db_file in checked_files:
-                    logger.debug('File %s already checked, skipping' % db_file)
+            files_to_check = self.rank_hash_candidates(f, files_to_check)
+            if len(files_to_check) > 1:
+                files_to_check = pieces.precheck_files(files_to_check, start_size, end_size)
+                logger.debug('Found %i files that can match' % len(files_to_check))
 
-                checked_files.add(db_file)
-                logger.info('Hash checking %s' % db_file)
-                match_start, match_end = pieces.match_file(db_file, start_size, end_size)
+            matches = pieces.match_files(files_to_check, start_size, end_size)
+            for db_file, (match_start, match_end) in matches:
+                logger.info('Hash checked %s' % db_file)
                 logger.info('We go result for file %s start:%s end:%s' % (db_file, match_start, match_end))
 
                 if match_start or match_end: # this file is all-good
@@ -166,7 +222,12 @@ class AutoTorrent(object):
                         f['completed'] = True
 
                     f['actual_path'] = db_file
+                    f.hash_checked = True
                     break
+            matches.close()
+
+        if pieces.cache is not None:
+            pieces.cache.sync()
 
         return modified_result, result
 
@@ -188,7 +249,7 @@ class AutoTorrent(object):
             paths = self.db.find_exact_file_path(prefix, torrent_name)
             if paths:
                 for path in paths:
-                    logger.debug('Checking exact path %r' % path)
+                    logger.debug('Checking exact path %r', path)
                     if prefix == 'f':
                         logger.info('Did an exact match to a file')
                         size = os.path.getsize(path)
@@ -197,33 +258,23 @@ class AutoTorrent(object):
 
                         return {'mode': 'exact',
                                 'source_path': os.path.dirname(path),
-                                'files': [{
-                                    'actual_path': path,
-                                    'length': size,
-                                    'path': [torrent_name],
-                                    'completed': True,
-                                }]}
+                                'files': [TorrentFile(0, [torrent_name], size, actual_path=path, completed=True)]}
                     else:
                         result = []
-                        for f in torrent[b'info'][b'files']:
+                        for i, f in enumerate(torrent[b'info'][b'files']):
                             orig_path = [self.try_decode(x) for x in f[b'path']]
                             p = os.path.join(path, *orig_path)
 
                             if not os.path.isfile(p):
-                                logger.debug('File %r does not exist' % p)
+                                logger.debug('File %r does not exist', p)
                                 break
 
                             size = os.path.getsize(p)
                             if size != f[b'length']:
-                                logger.debug('File %r did not match, this is not exact (got size %s, expected %s)' % (p, size, f[b'length']))
+                                logger.debug('File %r did not match, this is not exact (got size %s, expected %s)', p, size, f[b'length'])
                                 break
 
-                            result.append({
-                                'actual_path': p,
-                                'length': f[b'length'],
-                                'path': orig_path,
-                                'completed': True,
-                            })
+                            result.append(TorrentFile(i, orig_path, f[b'length'], actual_path=p, completed=True))
                         else:
                             logger.info('Did an exact match to a path')
                             return {'mode': 'exact',
@@ -233,33 +284,24 @@ class AutoTorrent(object):
 
         result = []
         if b'files' in torrent[b'info']: # multifile torrent
-            files_sorted = {}
-            files = {}
-            if b'files' in torrent[b'info']:
+            path_files = defaultdict(list)
+            for i, f in enumerate(torrent[b'info'][b'files']):
+                logger.debug('Handling torrent file %r', f)
+                orig_path = [self.try_decode(x) for x in f[b'path'] if x] # remove empty fragments
+                if not self.is_legal_path(orig_path):
+                    raise IllegalPathException('That is a dangerous torrent path %r, bailing' % orig_path)
 
-                i = 0
-                path_files = defaultdict(list)
-                for f in torrent[b'info'][b'files']:
-                    logger.debug('Handling torrent file %r' % (f, ))
-                    orig_path = [self.try_decode(x) for x in f[b'path'] if x] # remove empty fragments
-                    if not self.is_legal_path(orig_path):
-                        raise IllegalPathException('That is a dangerous torrent path %r, bailing' % orig_path)
+                path = [torrent_name] + orig_path
+                name = path.pop()
 
-                    path = [torrent_name] + orig_path
-                    name = path.pop()
-
-                    path_files[os.path.join(*path)].append({
-                        'path': orig_path,
-                        'length': f[b'length'],
-                    })
-
-                    files_sorted['/'.join(orig_path)] = i
-                    i += 1
+                record = TorrentFile(i, orig_path, f[b'length'])
+                result.append(record) # the records are found below, in place, so the result keeps the torrent order
+                path_files[os.path.join(*path)].append(record)
 
             if self.db.unsplitable_mode:
                 unsplitable_paths = set()
                 for path, files in path_files.items():
-                    if is_unsplitable(f['path'][-1] for f in files):
+                    if is_unsplitable(f.path[-1] for f in files):
                         path = path.split(os.sep)
                         name = get_root_of_unsplitable(path)
                         if not name:
@@ -269,6 +311,7 @@ class AutoTorrent(object):
                             path.pop()
                         unsplitable_paths.add(os.path.join(*path))
 
+            requests, request_files = [], []
             for path, files in path_files.items():
                 if self.db.unsplitable_mode:
                     path = path.split(os.sep)
@@ -279,30 +322,21 @@ class AutoTorrent(object):
 
                 if path:
                     name = path[-1]
-                    for f in files:
-                        actual_path = self.db.find_unsplitable_file_path(name, f['path'], f['length'])
-                        f['actual_path'] = actual_path
-                        f['completed'] = actual_path is not None
-                    result += files
+                    requests += [('unsplitable_file_path', (name, f.path, f.length)) for f in files]
                 else:
-                    for f in files:
-                        actual_path = self.db.find_file_path(f['path'][-1], f['length'])
-                        f['actual_path'] = actual_path
-                        f['completed'] = actual_path is not None
-                    result += files
-            # re-sort the torrent to fit original ordering
-            result = sorted(result, key=lambda x:files_sorted['/'.join(x['path'])])
+                    requests += [('file_path', (f.path[-1], f.length)) for f in files]
+                request_files += files
+
+            for f, actual_path in zip(request_files, self.db.find_many(requests)): # all files are looked up at once
+                f.actual_path = actual_path
+                f.completed = actual_path is not None
 
         else: # singlefile torrent
             length = torrent[b'info'][b'length']
             actual_path = self.db.find_file_path(torrent_name, length)
 
-            result.append({
-                'actual_path': actual_path,
-                'length': length,
-                'path': [torrent_name],
-                'completed': actual_path is not None,
-            })
+            result.append(TorrentFile(0, [torrent_name], length, actual_path=actual_path,
+                                      completed=actual_path is not None))
 
         mode = 'link'
         if self.db.hash_mode:
@@ -312,12 +346,72 @@ class AutoTorrent(object):
 
         return {'mode': mode, 'files': result}
 
+    def verify_files(self, torrent, files):
+        """
+        Checks a sample of the pieces of the found files and marks the files
+        where a piece did not match as missing, within what is left of verify_budget.
+        """
+        checks = [(f['actual_path'] if f['completed'] else None, f['length']) for f in files]
+        if not any(file_path for file_path, _ in checks):
+            return
+
+        limit = None
+        if self.verify_budget:
+            limit = (self.verify_budget - self.verified_bytes) // torrent[b'info'][b'piece length']
+            if limit <= 0:
+                logger.info('The verify budget of %s is used up, not verifying the files' % humanize_bytes(self.verify_budget))
+                return
+
+        pieces = self.get_pieces(torrent)
+        failed = set(pieces.verify_files(checks, self.verify_ratio, limit))
+        self.verified_bytes += pieces.pieces_verified * pieces.piece_size
+        if pieces.cache is not None:
+            pieces.cache.sync()
+
+        for f in files:
+            if f['completed'] and f['actual_path'] in failed:
+                logger.warning('Pieces of %r do not match the torrent, taking it as missing' % f['actual_path'])
+                f['completed'] = False
+                f['actual_path'] = None
+
+    def find_verified_pieces(self, torrent, destination_path, files):
+        """
+        Hashes the pieces of the files found by hash checking as they are in destination_path,
+        after linking and rewriting, and sets verified_pieces of those files to the pieces that matched.
+        Only a part of the pieces was checked when the files were found, the rest is not known to match.
+        """
+        piece_size = torrent[b'info'][b'piece length']
+        checks, file_pieces, wanted = [], [], set()
+        position = 0
+        for f in files:
+            found = f['completed'] or 'postprocessing' in f
+            checks.append((os.path.join(destination_path, *f['path']) if found else None, f['length']))
+            file_pieces.append(range(position // piece_size, (position + f['length'] + piece_size - 1) // piece_size))
+            if f.hash_checked:
+                wanted.update(file_pieces[-1])
+            position += f['length']
+        
+        if not wanted:
+            return
+        
+        pieces = self.get_pieces(torrent)
+        matched = pieces.match_pieces(checks, wanted)
+        if pieces.cache is not None:
+            pieces.cache.sync()
+        
+        for f, indexes in zip(files, file_pieces):
+            if f.hash_checked:
+                f['verified_pieces'] = [piece for piece in indexes if piece in matched]
+                logger.debug('%i of %i pieces of %r matched' % (len(f['verified_pieces']), len(indexes), f['path']))
+    
     def parse_torrent(self, torrent):
         """
         Parses the torrent and finds the physical location of files
         in the torrent
         """
         files = self.index_torrent(torrent)
+        if self.verify_ratio and files['mode'] in ('link', 'hash'):
+            self.verify_files(torrent, files['files'])
 
         found_size, missing_size = 0, 0
         for f in files['files']:
@@ -452,42 +546,9 @@ class AutoTorrent(object):
                 logger.debug('Rewriting file from %r to %r' % (f['actual_path'], destination))
 
                 _, modification_action, modification_point = f['postprocessing']
-                current_size = os.path.getsize(f['actual_path'])
-                expected_size = f['length']
-                diff = abs(current_size - expected_size)
-
-                # write until modification_point, do action, write rest of file
-
-                modified = False
-                bytes_written = 0
-                with open(destination, 'wb') as output_fp:
-                    with open(f['actual_path'], 'rb') as input_fp:
-                        logger.debug('Opened file %s and writing its data to %s - The breakpoint is %i' % (f['actual_path'], destination, modification_point))
-                        while True:
-                            if not modified and bytes_written == modification_point:
-                                logger.debug('Time to modify with action %s and bytes %i' % (modification_action, diff))
-                                modified = True
-                                if modification_action == 'remove':
-                                    seek_point = bytes_written + diff
-                                    logger.debug('Have to shrink compared to original file, seeking to %i' % (seek_point, ))
-                                    input_fp.seek(seek_point)
-                                elif modification_action == 'add':
-                                    logger.debug('Need to add data, writing %i empty bytes' % diff)
-                                    while diff > 0:
-                                        write_bytes = min(CHUNK_SIZE, diff)
-                                        output_fp.write(b'\x00' * write_bytes)
-                                        diff -= write_bytes
-
-                            read_bytes = CHUNK_SIZE
-                            if not modified:
-                                read_bytes = min(read_bytes, modification_point-bytes_written)
-
-                            logger.debug('Reading %i bytes' % (read_bytes, ))
-                            data = input_fp.read(read_bytes)
-                            if not data:
-                                break
-                            output_fp.write(data)
-                            bytes_written += read_bytes
+                diff = abs(os.path.getsize(f['actual_path']) - f['length'])
+                rewrite_file(f['actual_path'], destination, modification_action, modification_point, diff,
+                             sparse=self.sparse_rewrites)
                 logger.debug('Done rewriting file')
 
     def handle_torrentfile(self, path, dry_run=False):
@@ -538,9 +599,12 @@ class AutoTorrent(object):
 
         fast_resume = True
         if files['mode'] == 'hash':
-            fast_resume = False
+            fast_resume = self.client.partial_resume
             logger.info('There are files found using hashing that needs rewriting.')
             self.rewrite_hashed_files(destination_path, files['files'])
+            if fast_resume:
+                logger.info('Hashing the files found using hashing, so only the matching pieces are resumed.')
+                self.find_verified_pieces(torrent, destination_path, files['files'])
 
         if self.delete_torrents:
             logger.info('Removing torrent %r' % path)
@@ -564,8 +628,7 @@ class AutoTorrent(object):
         """
         Opens and parses a torrent file
         """
-        with open(path, 'rb') as f:
-            return bdecode(f.read())
+        return Torrent.from_file(path)
 
     def print_status(self, status, torrentfile, message):
         print(' %-20s %r %s' % ('[%s]' % status_messages[status], os.path.splitext(os.path.basename(torrentfile))[0], message))
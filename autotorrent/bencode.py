@@ -13,59 +13,113 @@
 
 import six
 
-class BTFailure(Exception):
+class BTFailure(ValueError):
     pass
 
-def decode_int(x, f):
-    f += 1
-    newf = x.find(b'e', f)
-    n = int(x[f:newf])
-    if six.indexbytes(x, f) == 45:
-        if six.indexbytes(x, f+1) == 48:
-            raise ValueError
-    elif six.indexbytes(x, f) == 48 and newf != f+1:
-        raise ValueError
-    return (n, newf+1)
-
-def decode_string(x, f):
-    colon = x.find(b':', f)
-    n = int(x[f:colon])
-    if six.indexbytes(x, f) == 48 and colon != f+1:
-        raise ValueError
-    colon += 1
-    return (x[colon:colon+n], colon+n)
-
-def decode_list(x, f):
-    r, f = [], f+1
-    while six.indexbytes(x, f) != 101:
-        v, f = decode_func[six.indexbytes(x, f)](x, f)
-        r.append(v)
-    return (r, f + 1)
-
-def decode_dict(x, f):
-    r, f = {}, f+1
-    while six.indexbytes(x, f) != 101:
-        k, f = decode_string(x, f)
-        r[k], f = decode_func[six.indexbytes(x, f)](x, f)
-    return (r, f + 1)
-
-decode_func = {}
-decode_func[108] = decode_list
-decode_func[100] = decode_dict
-decode_func[105] = decode_int
-
-for i in range(48, 59):
-    decode_func[i] = decode_string
+# the first byte of a value decides its type, indexing bytes gives an int on python 3 and a str on python 2
+DECODE_INT, DECODE_STRING, DECODE_LIST, DECODE_DICT = range(4)
+decode_types = {b'i'[0]: DECODE_INT, b'l'[0]: DECODE_LIST, b'd'[0]: DECODE_DICT}
+for c in b'0123456789':
+    decode_types[c] = DECODE_STRING
 
-def bdecode(x):
+END, MINUS, ZERO = b'e'[0], b'-'[0], b'0'[0]
+
+VIEW_KEYS = set([b'pieces']) # strings under these keys are memoryviews of the input, not copies
+
+def decode(x, span_key=None):
+    """
+    Decodes the bencoded bytes x without recursion.
+
+    Returns the value and the (start, end) position in x of the value stored under
+    span_key in the outermost dict, or None if there is no such value.
+    """
     try:
-        r, l = decode_func[six.indexbytes(x, 0)](x, 0)
-    except (IndexError, KeyError, ValueError):
+        return _decode(x, span_key)
+    except BTFailure:
         raise
-        raise BTFailure("not a valid bencoded string")
-    if l != len(x):
-        raise BTFailure("invalid bencoded value (data after valid prefix)")
-    return r
+    except IndexError:
+        raise BTFailure("unexpected end of data")
+    except ValueError as e: # int() failing on malformed numbers
+        raise BTFailure("not a valid bencoded string: %s" % e)
+
+def _decode(x, span_key):
+    find = x.find
+    types = decode_types
+    view = memoryview(x)
+    stack = [] # the containers values are added to, with their key waiting for a value and start position
+    container, key, start = None, None, 0
+    span = None
+    f = 0
+    while True:
+        c = x[f]
+        if c == END:
+            if container is None or key is not None:
+                raise BTFailure("unexpected end of value at %i" % f)
+            f += 1
+            value = container
+            container, key, start_ = stack.pop()
+            if span_key is not None and key == span_key and len(stack) == 1:
+                span = (start, f)
+            start = start_
+        else:
+            value_type = types.get(c)
+            if value_type == DECODE_STRING:
+                colon = find(b':', f)
+                if colon == -1 or (c == ZERO and colon != f+1):
+                    raise BTFailure("invalid string length at %i" % f)
+                colon += 1
+                n = colon + int(x[f:colon-1])
+                if n > len(x):
+                    raise BTFailure("string at %i is longer than the data" % colon)
+                if key is not None and key in VIEW_KEYS:
+                    value = view[colon:n]
+                else:
+                    value = x[colon:n]
+                f = n
+            elif value_type == DECODE_INT:
+                end = find(b'e', f)
+                if end == -1:
+                    raise BTFailure("unterminated integer at %i" % f)
+                c = x[f+1]
+                if (c == ZERO and end != f+2) or (c == MINUS and x[f+2] == ZERO):
+                    raise BTFailure("invalid integer at %i" % f)
+                value = int(x[f+1:end])
+                f = end + 1
+            elif value_type == DECODE_LIST or value_type == DECODE_DICT:
+                stack.append((container, key, start))
+                container, key, start = ([] if value_type == DECODE_LIST else {}), None, f
+                f += 1
+                continue
+            else:
+                raise BTFailure("invalid value type %r at %i" % (x[f:f+1], f))
+
+        if container is None:
+            if f != len(x):
+                raise BTFailure("invalid bencoded value (data after valid prefix)")
+            return value, span
+
+        if type(container) is list:
+            container.append(value)
+        elif key is None:
+            if type(value) is not bytes:
+                raise BTFailure("dict key is not a string at %i" % f)
+            key = value
+        else:
+            container[key] = value
+            key = None
+
+def bdecode(x):
+    return decode(x)[0]
+
+def bdecode_torrent(x):
+    """
+    Decodes a torrent and returns it together with a memoryview of the
+    bencoded info dict in x, the info hash is the sha1 of it.
+    """
+    r, span = decode(x, b'info')
+    if span is None:
+        raise BTFailure("torrent has no info dict")
+    return r, memoryview(x)[span[0]:span[1]]
 
 
 class Bencached(object):
@@ -89,6 +143,9 @@ def encode_bool(x, r):
 def encode_string(x, r):
     r.extend((str(len(x)).encode(), b':', x))
 
+def encode_memoryview(x, r):
+    r.extend((str(len(x)).encode(), b':', x.tobytes() if six.PY2 else x))
+
 def encode_list(x, r):
     r.append(b'l')
     for i in x:
@@ -109,6 +166,7 @@ if six.PY2:
     encode_func[long] = encode_int
 encode_func[str] = encode_string
 encode_func[bytes] = encode_string
+encode_func[memoryview] = encode_memoryview
 encode_func[list] = encode_list
 encode_func[tuple] = encode_list
 encode_func[dict] = encode_dict
@@ -123,3 +181,23 @@ def bencode(x):
     r = []
     encode_func[type(x)](x, r)
     return b''.join(r)
+
+class StreamWriter(object):
+    """
+    Takes the place of the list of encoded parts and writes them to a file-like object instead.
+    """
+    __slots__ = ['append']
+
+    def __init__(self, f):
+        self.append = f.write
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+def bencode_to(x, f):
+    """
+    Encodes x and writes it to the file-like object f while encoding, without
+    keeping the encoded value in memory. Bencached values are written as they are.
+    """
+    encode_func[type(x)](x, StreamWriter(f))
@@ -1,5 +1,6 @@
 class BaseClient(object):
     identifier = None # used to identify it in the config file
+    partial_resume = False # if add_torrent can mark only the verified_pieces of files found by hash checking as done
 
     @classmethod
     def auto_config(cls):
@@ -33,5 +34,8 @@ class BaseClient(object):
     def add_torrent(self, torrent, destination_path, files, fast_resume=True):
         """
         Adds a torrent to the torrent client.
+
+        Files with verified_pieces were found by hash checking, only the pieces
+        listed there are known to match, the others must be checked or downloaded.
         """
         raise NotImplementedError
\ No newline at end of file
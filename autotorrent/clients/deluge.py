@@ -1,7 +1,6 @@
 from __future__ import division
 
 import base64
-import hashlib
 import logging
 import os
 import re
@@ -9,7 +8,7 @@ import re
 from deluge_client import DelugeRPCClient
 
 from ._base import BaseClient
-from ..bencode import bencode
+from ..torrent import encode_torrent, get_info_hash
 from ..humanize import humanize_bytes
 
 logger = logging.getLogger(__name__)
@@ -129,8 +128,8 @@ class DelugeClient(BaseClient):
 
         destination_path = os.path.abspath(destination_path)
 
-        infohash = hashlib.sha1(bencode(torrent[b'info'])).hexdigest()
-        encoded_torrent = base64.b64encode(bencode(torrent))
+        infohash = get_info_hash(torrent)
+        encoded_torrent = base64.b64encode(encode_torrent(torrent))
 
         if b'files' not in torrent[b'info'] and not destination_path.endswith(os.sep):
             logger.debug('Singlefile torrent, adding sep to avoid weird naming in Deluge')
@@ -6,7 +6,7 @@ import requests
 from requests.compat import urljoin
 
 from ._base import BaseClient
-from ..bencode import bencode
+from ..torrent import encode_torrent
 
 logger = logging.getLogger(__name__)
 
@@ -95,7 +95,7 @@ class QBittorrentClient(BaseClient):
 
         destination_path = os.path.abspath(destination_path)
 
-        encoded_torrent = bencode(torrent)
+        encoded_torrent = encode_torrent(torrent)
 
         if b'files' in torrent[b'info']:
             movable_files = os.listdir(destination_path)
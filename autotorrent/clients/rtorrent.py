@@ -1,6 +1,5 @@
 from __future__ import division
 
-import hashlib
 import logging
 import os
 import re
@@ -11,7 +10,7 @@ from six.moves.urllib.parse import quote, urlsplit
 from six.moves.xmlrpc_client import ServerProxy
 
 from ._base import BaseClient
-from ..bencode import bencode
+from ..torrent import encode_torrent, get_info_hash
 from ..scgitransport import SCGITransport
 
 logger = logging.getLogger(__name__)
@@ -46,6 +45,7 @@ def bitfield_to_string(bitfield):
 
 class RTorrentClient(BaseClient):
     identifier = 'rtorrent'
+    partial_resume = True
     sleep_time = 1
     _methods = None
 
@@ -149,8 +149,12 @@ class RTorrentClient(BaseClient):
             for f in files:
                 logger.debug('Handling file %r' % f)
 
-                result = {b'priority': 1, b'completed': int(f['completed'])}
-                if f['completed']:
+                verified_pieces = f.get('verified_pieces')
+                if verified_pieces is not None:
+                    verified_pieces = set(verified_pieces)
+                exists = f['completed'] or verified_pieces is not None
+                result = {b'priority': 1, b'completed': int(exists)}
+                if exists:
                     result[b'mtime'] = self._get_mtime(os.path.join(destination_path, *f['path']))
                 torrent[b'libtorrent_resume'][b'files'].append(result)
 
@@ -160,8 +164,12 @@ class RTorrentClient(BaseClient):
                 last_piece = (last_position+psize-1) // psize
 
                 for piece in range(first_piece, last_piece):
-                    logger.debug('Setting piece %s to %s' % (piece, f['completed']))
-                    bitfield[piece] *= f['completed']
+                    if verified_pieces is not None:
+                        completed = piece in verified_pieces
+                    else:
+                        completed = f['completed']
+                    logger.debug('Setting piece %s to %s' % (piece, completed))
+                    bitfield[piece] *= completed
 
                 current_position = last_position
 
@@ -174,9 +182,9 @@ class RTorrentClient(BaseClient):
 
         torrent_file = os.path.join(destination_path, '__tmp_torrent%s.torrent' % uuid.uuid4())
         with open(torrent_file, 'wb') as f:
-            f.write(bencode(torrent))
+            encode_torrent(torrent, f)
 
-        infohash = hashlib.sha1(bencode(torrent[b'info'])).hexdigest()
+        infohash = get_info_hash(torrent)
 
         if 'load.start' in self.get_methods():
             cmd = [torrent_file, 'd.directory_base.set="%s"' % os.path.abspath(destination_path)]
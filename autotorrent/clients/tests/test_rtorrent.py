@@ -56,7 +56,7 @@ class TestRTorrentClient(TestCase):
     def test_test_connection(self):
         self.assertEqual(self.client.test_connection(), "cwd:'/home/user/rtorrent', pid:10000")
 
-    def _add_torrent_with_links(self, letters):
+    def _add_torrent_with_links(self, letters, verified_pieces={}):
         with open(os.path.join(current_path, 'test.torrent'), 'rb') as f:
             torrent = bdecode(f.read())
 
@@ -68,6 +68,8 @@ class TestRTorrentClient(TestCase):
                 'length': 11,
                 'path': ['tmp', filename],
             })
+            if letter in verified_pieces:
+                files[-1]['verified_pieces'] = verified_pieces[letter]
 
         return self.client.add_torrent(torrent, '/tmp/', files)
 
@@ -106,6 +108,28 @@ class TestRTorrentClient(TestCase):
         bitfield = resume_data[b'bitfield']
         self.assertEqual(bitfield, b'\x98') # bitfield: 10011 000
 
+    def test_add_torrent_partially_verified(self):
+        self.assertTrue(self._add_torrent_with_links(['a', 'c'], {'b': [2]}))
+        torrent = self.client.proxy.torrents['2CE6B00E106F26A7C56DBD2C52290E4B6DEA10C0']
+
+        resume_data = torrent[b'libtorrent_resume']
+
+        self.assertEqual(resume_data[b'files'], [
+            {b'priority': 1, b'completed': 1, b'mtime': 1000},
+            {b'priority': 1, b'completed': 1, b'mtime': 1000},
+            {b'priority': 1, b'completed': 1, b'mtime': 1000}
+        ])
+
+        bitfield = resume_data[b'bitfield']
+        self.assertEqual(bitfield, b'\xb8') # bitfield: 10111 000
+
+    def test_add_torrent_completed_partially_verified(self):
+        self.assertTrue(self._add_torrent_with_links(['a', 'b', 'c'], {'c': [4]}))
+        torrent = self.client.proxy.torrents['2CE6B00E106F26A7C56DBD2C52290E4B6DEA10C0']
+
+        bitfield = torrent[b'libtorrent_resume'][b'bitfield']
+        self.assertEqual(bitfield, b'\xc8') # bitfield: 11001 000
+
     def test_auto_config_successful_config_port(self):
         os.environ['HOME'] = self._temp_path
 
@@ -8,7 +8,7 @@ import os
 import requests
 
 from ._base import BaseClient
-from ..bencode import bencode
+from ..torrent import encode_torrent
 
 logger = logging.getLogger(__name__)
 
@@ -130,7 +130,7 @@ class TransmissionClient(BaseClient):
 
         destination_path = os.path.abspath(destination_path)
 
-        encoded_torrent = base64.b64encode(bencode(torrent))
+        encoded_torrent = base64.b64encode(encode_torrent(torrent))
 
         if b'files' in torrent[b'info']:
             download_dir = os.path.dirname(destination_path)
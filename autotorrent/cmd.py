@@ -1,3 +1,5 @@
+from __future__ import division
+
 import argparse
 import json
 import logging
@@ -8,8 +10,9 @@ from six.moves import configparser, input
 
 from autotorrent.at import AutoTorrent
 from autotorrent.clients import TORRENT_CLIENTS
-from autotorrent.db import Database
+from autotorrent.db import Database, KEY_FORMATS
 from autotorrent.humanize import humanize_bytes
+from autotorrent.storage import STORAGE_BACKENDS
 
 def query_yes_no(question, default="yes"):
     """Ask a yes/no question via raw_input() and return their answer.
@@ -52,12 +55,17 @@ def commandline_handler():
     parser.add_argument("-t", "--test_connection", action="store_true", dest="test_connection", default=False, help='Tests the connection to the torrent client')
     parser.add_argument("--dry-run", nargs='?', const='txt', default=None, dest="dry_run", choices=['txt', 'json'], help="Don't add any torrents to client, just scan for files needed for torrents.")
     parser.add_argument("-r", "--rebuild", dest="rebuild", default=False, help='Rebuilds the database (necessary for new files/file changes on disk).', nargs='*')
+    parser.add_argument("-i", "--incremental", action="store_true", dest="incremental", default=False, help='Only rescan directories that changed since the last rebuild, used together with --rebuild.')
     parser.add_argument("-a", "--addfile", dest="addfile", default=False, help='Add a new torrent file to client', nargs='+')
     parser.add_argument("-d", "--delete_torrents", action="store_true", dest="delete_torrents", default=False, help='Delete .torrent files when they are added to the client succesfully.')
+    parser.add_argument("--verify", action="store_true", dest="verify", default=False, help='Check pieces of the files found before adding a torrent, files that do not match are taken as missing.')
     parser.add_argument("--verbose", help="increase output verbosity", action="store_true", dest="verbose")
     
     args = parser.parse_args()
     
+    if args.incremental and not isinstance(args.rebuild, list):
+        parser.error('--incremental only works together with --rebuild')
+    
     logging.basicConfig(level=logging.DEBUG if args.verbose else logging.ERROR)
     
     if args.create_config_file: # autotorrent.conf
@@ -148,10 +156,25 @@ def commandline_handler():
     hash_size_mode = 'hash_size' in scan_mode
     hash_slow_mode = 'hash_slow' in scan_mode
     
+    db_backend = (config.get('general', 'db_backend') if config.has_option('general', 'db_backend') else 'shelve')
+    if db_backend not in STORAGE_BACKENDS:
+        print('Unknown db_backend %r - Known backends are: %s' % (db_backend, ', '.join(STORAGE_BACKENDS.keys())))
+        quit(1)
+    
+    db_key_format = (config.get('general', 'db_key_format') if config.has_option('general', 'db_key_format') else 'sha256')
+    if db_key_format not in KEY_FORMATS:
+        print('Unknown db_key_format %r - Known formats are: %s' % (db_key_format, ', '.join(KEY_FORMATS)))
+        quit(1)
+    
     db = Database(config.get('general', 'db'), disks,
                   config.get('general', 'ignore_files').split(','),
                   normal_mode, unsplitable_mode, exact_mode,
-                  hash_name_mode, hash_size_mode, hash_slow_mode)
+                  hash_name_mode, hash_size_mode, hash_slow_mode,
+                  db_backend,
+                  (config.getint('general', 'scan_workers') if config.has_option('general', 'scan_workers') else 4),
+                  (config.getint('general', 'write_batch_size') if config.has_option('general', 'write_batch_size') else 10000),
+                  db_key_format,
+                  (config.getboolean('general', 'lookup_index') if config.has_option('general', 'lookup_index') else False))
     
     client_option = 'client'
     if args.client != 'default':
@@ -171,6 +194,15 @@ def commandline_handler():
     client_options.pop('client')
     client = TORRENT_CLIENTS[client_name](**client_options)
     
+    piece_cache_path = None
+    if not config.has_option('general', 'piece_cache') or config.getboolean('general', 'piece_cache'):
+        piece_cache_path = '%s.pieces' % config.get('general', 'db')
+    
+    verify_ratio, verify_budget = 0, 0
+    if args.verify or (config.has_option('general', 'verify') and config.getboolean('general', 'verify')):
+        verify_ratio = config.getfloat('general', 'verify_ratio') if config.has_option('general', 'verify_ratio') else 0.05
+        verify_budget = config.getint('general', 'verify_budget') if config.has_option('general', 'verify_budget') else 0
+    
     at = AutoTorrent(
         db,
         client,
@@ -179,6 +211,11 @@ def commandline_handler():
         config.getfloat('general', 'add_limit_percent'),
         args.delete_torrents,
         (config.get('general', 'link_type') if config.has_option('general', 'link_type') else 'soft'),
+        (config.getint('general', 'hash_workers') if config.has_option('general', 'hash_workers') else 4),
+        piece_cache_path,
+        (config.getboolean('general', 'sparse_rewrite') if config.has_option('general', 'sparse_rewrite') else True),
+        verify_ratio,
+        verify_budget,
     )
     
     if args.test_connection:
@@ -190,12 +227,22 @@ def commandline_handler():
     if isinstance(args.rebuild, list):
         if args.rebuild:
             print('Adding new folders to database')
-            db.rebuild(args.rebuild)
+            stats = db.rebuild(args.rebuild, incremental=args.incremental)
             print('Added to database')
+        elif args.incremental:
+            print('Incrementally rebuilding database')
+            stats = db.rebuild(incremental=True)
+            print('Database rebuilt')
         else:
             print('Rebuilding database')
-            db.rebuild()
+            stats = db.rebuild()
             print('Database rebuilt')
+        
+        for path_stats in stats:
+            seconds = max(path_stats['seconds'], 0.001)
+            print(' %s - %i directories, %i files (%s) in %.1f seconds - %.1f files/s, %s/s' % (
+                path_stats['path'], path_stats['directories'], path_stats['files'], humanize_bytes(path_stats['bytes']),
+                path_stats['seconds'], path_stats['files'] / seconds, humanize_bytes(path_stats['bytes'] / seconds)))
 
     
     if args.addfile:
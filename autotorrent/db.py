@@ -3,26 +3,73 @@ from __future__ import division, unicode_literals
 import hashlib
 import logging
 import os
-import shelve
+import stat
+import threading
+import time
+import uuid
 
+from array import array
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
 from fnmatch import fnmatch
+from six.moves.queue import Queue
 
-from .utils import is_unsplitable, get_root_of_unsplitable
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+from .index import LookupIndex, SizeIndex, SIZE_TYPECODE
+from .storage import STORAGE_BACKENDS, WriteBuffer
+from .storage._base import SINGLE_TABLES, TABLES
+from .utils import is_unsplitable, get_root_of_unsplitable, is_unsplitable_subfolder
 
 logger = logging.getLogger(__name__)
 
+SCAN_QUEUE_SIZE = 10000 # max number of scanned directories waiting for the database writer
+KEY_CACHE_SIZE = 100000 # max number of keys and normalized filenames remembered, the caches are emptied when full
+KEY_FORMATS = ('sha256', 'plain')
+PLAIN_KEY_PREFIX = 'k:'
+FIND_KINDS = { # the table searched by each kind of find_many request
+    'file_path': 'normal',
+    'unsplitable_file_path': 'unsplitable',
+    'exact_file_path': 'exact',
+    'hash_name': 'hash_name',
+    'hash_size': 'hash_size',
+}
+
 class Database(object):
     hash_mode_size_varying = 10.0 # 10% size variation from size on disk for the two scan modes
                                   # that allows size to vary
+    scan_prefetch = 4 # number of directories scanned ahead, per worker
+    write_batch_memory = 64 * 1024 * 1024 # estimated bytes of buffered writes that triggers a write to the storage
+    key_format = 'sha256'
+    scan_roots = () # the paths scanned by the running rebuild, a file found in a later one wins over earlier ones
+    removed_keys = None # the single path keys removed by the running rebuild, other files can have the same key
+    index = None
+    _db = None
+    _key_cache = None
+    _normalize_cache = None
     
     def __init__(self, db_file, paths, ignore_files, normal_mode, unsplitable_mode, exact_mode,
-                 hash_name_mode, hash_size_mode, hash_slow_mode):
+                 hash_name_mode, hash_size_mode, hash_slow_mode, db_backend='shelve', scan_workers=4,
+                 write_batch_size=10000, key_format='sha256', lookup_index=False):
         """
         Database used to match files and torrents.
+
+        db_backend is the identifier of the storage used, see autotorrent.storage.
+        scan_workers is the number of threads accessing the disks during a rebuild.
+        write_batch_size is the number of entries buffered during a rebuild before they are written to the storage.
+        key_format is how keys are made when the database is rebuilt, see KEY_FORMATS.
+        Lookups use the format the database was built with.
+        lookup_index compiles the database into a read-only lookup index after it is rebuilt.
+        
+        When the lookup index exists, lookups use it and the storage is only opened when needed.
         """
-        self.db = shelve.open(db_file)
+        self.db_backend = db_backend
         self.db_file = db_file
         self.paths = paths
+        self.path_roots = [os.path.abspath(p) for p in paths]
         self.ignore_files = [self.normalize_filename(x) for x in ignore_files]
         self.normal_mode = normal_mode
         self.unsplitable_mode = unsplitable_mode
@@ -32,66 +79,193 @@ class Database(object):
         self.hash_slow_mode = hash_slow_mode
         self.hash_mode = hash_name_mode or hash_size_mode or hash_slow_mode
         self.hash_size_table = None
+        self.scan_workers = scan_workers
+        self.write_batch_size = write_batch_size
+        self.write_buffer = None
+        self.db_key_format = key_format
+        self.lookup_index = lookup_index
+        self.index = LookupIndex.open(self.get_lookup_index_path())
+        if self.index is not None:
+            self.key_format = self.index.key_format
+        else:
+            self.key_format = self.db.get_meta('key_format', 'sha256')
+        self._access_ids = None
+    
+    @property
+    def db(self):
+        """
+        The storage, opened when first used.
+        """
+        if self._db is None:
+            storage_cls = STORAGE_BACKENDS[self.db_backend]
+            self._db = storage_cls(self.db_file + storage_cls.file_suffix)
+        return self._db
+    
+    @db.setter
+    def db(self, value):
+        self._db = value
     
     def truncate(self):
         """
         Truncates the database
         """
         logger.info('Truncated the database')
-        self.db.close()
-        self.db = shelve.open(self.db_file, flag='n')
+        self.remove_lookup_index()
+        self.db.truncate()
+    
+    def get_lookup_index_path(self):
+        """
+        Returns the path of the lookup index stored next to the database.
+        """
+        return '%s.index' % self.db_file
+    
+    def remove_lookup_index(self):
+        """
+        Removes the lookup index, it is out of date as soon as the database is changed.
+        """
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+        
+        path = self.get_lookup_index_path()
+        if os.path.isfile(path):
+            logger.info('Removing lookup index %r' % path)
+            os.remove(path)
+    
+    def compile_lookup_index(self):
+        """
+        Compiles the database into the lookup index and starts using it.
+        """
+        path = self.get_lookup_index_path()
+        logger.info('Compiling lookup index %r' % path)
+        def items(table):
+            for key in self.db.keys(table):
+                yield key, self.db.get(table, key)
+        
+        LookupIndex.write(path, self.key_format, dict((table, items(table)) for table in TABLES))
+        self.index = LookupIndex.open(path)
+    
+    def lookup(self, table, key):
+        """
+        Returns what is stored under key in table, like the storage get does.
+        """
+        if self.index is not None:
+            value = self.index.get(table, key, table in SINGLE_TABLES)
+        else:
+            value = self.db.get(table, key)
+        
+        if table in SINGLE_TABLES:
+            return value
+        return self.sort_paths(value)
+    
+    def lookup_many(self, table, keys):
+        """
+        Returns a dict of every key in keys to what is stored under it in table, like the storage get_many does.
+        """
+        single = table in SINGLE_TABLES
+        if self.index is not None:
+            result = dict((key, self.index.get(table, key, single)) for key in keys)
+        else:
+            result = self.db.get_many(table, keys)
+        
+        if not single:
+            for key, value in result.items():
+                result[key] = self.sort_paths(value)
+        return result
     
-    def insert_into_database(self, root, f, mode, prefix=None, unsplitable_name=None):
+    def insert_into_database(self, root, f, mode, prefix=None, unsplitable_name=None, stats=None):
         """
         Wraps the database insert to catch exceptions
+
+        Returns a (table, key, path) tuple of the entry or None if it was not inserted. The entry is
+        returned when a file found in a later path keeps the key too, so the key can be given back
+        to the file if the other is removed.
         """
         try:
-            self._insert_into_database(root, f, mode, prefix, unsplitable_name)
+            return self._insert_into_database(root, f, mode, prefix, unsplitable_name, stats)
         except UnicodeDecodeError:
             logger.error('Failed to insert %r / %r / %r' % (root, f, mode))
 
-    def _insert_into_database(self, root, f, mode, prefix=None, unsplitable_name=None):
+    def _insert_into_database(self, root, f, mode, prefix=None, unsplitable_name=None, stats=None):
         """
         Does the actual insertion into the database.
+
+        stats are the stat results found when listing root, if not given the disk is checked.
         """
         path = os.path.abspath(os.path.join(root, f))
-        if not os.access(path, os.R_OK):
+        if stats is not None:
+            if f not in stats: # not accessible, already logged by list_directory
+                return
+            st = stats[f]
+        elif not os.access(path, os.R_OK):
             logger.warning('Path %r is not accessible, skipping' % path)
             return
+        else:
+            st = os.stat(path)
         
+        storage = self.write_buffer or self.db
         if mode == 'exact':
+            table = 'exact'
             key = self.keyify(prefix, f)
-            if key in self.db:
-                self.db[key] = self.db[key] + [path]
-            else:
-                self.db[key] = [path]
+            storage.add(table, key, path, name=self.normalize_filename(f))
         else:
             normalized_filename = self.normalize_filename(f)
-            size = os.path.getsize(path)
+            size = st.st_size
             
             if mode.startswith('hash_'):
                 if mode == 'hash_store_name': # the size can vary, name is exact. I.e. filename to path mapping
+                    table = 'hash_name'
                     key = self.keyify(normalized_filename)
                 elif mode == 'hash_store_size': # the name can vary, size is exact (same db can be used for slow-mo). I.e. size to path mapping
-                    key = str('s:%i' % size)
-                self.db[key] = self.db.get(key, []) + [path]
+                    table = 'hash_size'
+                    key = size
             else:
                 if mode == 'unsplitable':
                     split_root = root.split(os.sep)
                     p_index = len(split_root) - split_root[::-1].index(unsplitable_name) - 1
                     p = [self.normalize_filename(x) for x in split_root[p_index:]] + [normalized_filename]
                     
+                    table = 'unsplitable'
                     key = self.keyify(size, *p)
                 elif mode == 'normal':
+                    table = 'normal'
                     key = self.keyify(size, normalized_filename)
                 
-                if key in self.db: # check if same file
-                    old_inode = os.stat(self.db[key]).st_ino
-                    new_inode = os.stat(path).st_ino
-                    if old_inode != new_inode:
-                        logger.warning('Duplicate key %s and %s' % (path, self.db[key]))
+                old_path = storage.get(table, key)
+                if old_path is not None: # check if same file
+                    try:
+                        old_inode = os.stat(old_path).st_ino
+                    except OSError: # the old file was removed since it was scanned
+                        old_inode = None
+                    if old_inode is not None and old_inode != st.st_ino:
+                        logger.warning('Duplicate key %s and %s' % (path, old_path))
+                    
+                    if old_inode is not None and self.get_path_rank(old_path, self.scan_roots) > self.get_path_rank(path, self.scan_roots):
+                        logger.debug('Keeping %r found in a later path over %r' % (old_path, path))
+                        return table, key, path
+            
+            storage.add(table, key, path, size=size, name=normalized_filename)
+        
+        return table, key, path
     
-                self.db[key] = path
+    def get_path_rank(self, path, roots):
+        """
+        Returns the position in roots of the root that contains path, -1 if none does.
+        """
+        rank, rank_root = -1, ''
+        for i, root in enumerate(roots):
+            if (path == root or path.startswith(root.rstrip(os.sep) + os.sep)) and len(root) >= len(rank_root):
+                rank, rank_root = i, root
+        return rank
+    
+    def sort_paths(self, paths):
+        """
+        Orders the paths stored for a key in a list table by the configured path they are in,
+        like a rebuild scanning the paths one after the other would have stored them.
+        """
+        if len(paths) < 2 or len(self.path_roots) < 2:
+            return paths
+        return sorted(paths, key=lambda path: self.get_path_rank(path, self.path_roots))
     
     def skip_file(self, f):
         """
@@ -103,103 +277,481 @@ class Database(object):
                 return True
         return False
     
-    def rebuild(self, paths=None):
+    def get_scan_settings(self):
+        """
+        Returns the settings that affect what is stored in the database.
+        An incremental rebuild is only possible when these did not change.
+        """
+        return {
+            'ignore_files': sorted(self.ignore_files),
+            'normal_mode': self.normal_mode,
+            'unsplitable_mode': self.unsplitable_mode,
+            'exact_mode': self.exact_mode,
+            'hash_name_mode': self.hash_name_mode,
+            'hash_size_mode': self.hash_size_mode,
+            'hash_slow_mode': self.hash_slow_mode,
+        }
+    
+    def get_directory_signature(self, path, st=None):
+        """
+        Returns a signature that changes when entries are added to, removed from or renamed in a directory.
+        st is the result of a stat of the directory if it is already known.
+        Returns None if the directory cannot be accessed.
+        """
+        if st is None:
+            try:
+                st = os.stat(path)
+            except OSError:
+                logger.warning('Unable to stat directory %r, skipping' % path)
+                return None
+        
+        return (st.st_mtime, st.st_ino, st.st_dev)
+    
+    def is_readable(self, path, st):
         """
-        Scans the paths for files and rebuilds the database.
+        Checks if path can be read like os.access(path, os.R_OK), using the permission bits
+        of its stat result first. The filesystem is only asked when the bits deny access,
+        as ACLs or capabilities can still allow it.
+        """
+        if self._access_ids is None:
+            if not hasattr(os, 'geteuid'):
+                return os.access(path, os.R_OK)
+            self._access_ids = (os.geteuid(), set(os.getgroups()) | set([os.getegid()]))
+        
+        uid, gids = self._access_ids
+        if uid == 0:
+            return True
+        elif st.st_uid == uid:
+            readable = st.st_mode & stat.S_IRUSR
+        elif st.st_gid in gids:
+            readable = st.st_mode & stat.S_IRGRP
+        else:
+            readable = st.st_mode & stat.S_IROTH
+        
+        return bool(readable) or os.access(path, os.R_OK)
+    
+    def list_directory(self, path, stat_entries=False):
         """
+        Lists a directory with scandir and returns a tuple of (dirs, files, links, stats),
+        similar to os.walk. links are the dirs that are symlinks.
+        
+        With stat_entries, stats is a dict of name to stat result for the readable entries,
+        the stat is done by the DirEntry so the filesystem is only asked once. Otherwise it is None.
+        
+        Returns None if the directory cannot be listed.
+        """
+        try:
+            entries = list(scandir(path))
+        except OSError:
+            logger.warning('Unable to list directory %r, skipping' % path)
+            return None
+        
+        dirs, files, links = [], [], set()
+        stats = {} if stat_entries else None
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            
+            if is_dir:
+                dirs.append(entry.name)
+                if entry.is_symlink():
+                    links.add(entry.name)
+            else:
+                files.append(entry.name)
+            
+            if stat_entries:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    st = None
+                
+                if st is None or not self.is_readable(entry.path, st):
+                    logger.warning('Path %r is not accessible, skipping' % os.path.abspath(entry.path))
+                    continue
+                
+                stats[entry.name] = st
+        
+        return dirs, files, links, stats
+    
+    def scan_directory(self, root, incremental=False, stat_files=False, st=None):
+        """
+        Does the disk access needed to scan a directory, it is called from the scan workers.
+        st is the stat result of root, if known from listing its parent.
+        
+        Returns a tuple of (root, dirs, files, links, signature, record, stats) or None
+        if the directory cannot be accessed.
+        """
+        signature = self.get_directory_signature(root, st)
+        if signature is None:
+            return None
+        
+        record = self.db.get_directory(root)
+        if incremental and record and record['signature'] == signature:
+            dirs, files, links, stats = record['dirs'], None, record['links'], None
+        else:
+            listing = self.list_directory(root, stat_files)
+            if listing is None:
+                return None
+            dirs, files, links, stats = listing
+        
+        return root, dirs, files, links, signature, record, stats
+    
+    def walk(self, root_path, executor, incremental=False, stat_files=False, classify=False):
+        """
+        Walks root_path top-down like os.walk, the directories are scanned ahead by the executor.
+        
+        When incremental is true, directories with an unchanged signature are not listed,
+        their subdirectories are taken from the stored directory record instead.
+        
+        When classify is true, every directory is checked for being part of an unsplitable release.
+        A release root is found by looking at its own files and the files of its release subfolders
+        (e.g. cd1, sample or bdmv), which are scanned early and yielded later in walk order.
+        
+        Yields tuples of (root, dirs, files, links, signature, record, stats, release) where files is None
+        if the directory was not listed, links are the dirs that are symlinks, stats is None unless stat_files is true and release
+        is the name of the unsplitable release the directory is part of.
+        """
+        root_path = os.path.abspath(root_path)
+        futures = {}
+        
+        def submit(path, st=None):
+            if path not in futures:
+                futures[path] = executor.submit(self.scan_directory, path, incremental, stat_files, st)
+            return futures[path]
+        
+        def is_release(result):
+            """
+            Checks if the files of a directory or its release subfolders make it an unsplitable release.
+            """
+            if result is None:
+                return False
+            
+            root, dirs, files, links, signature, record, stats = result
+            if files is None:
+                unsplitable = record['unsplitable']
+            else:
+                unsplitable = is_unsplitable(files)
+            
+            if unsplitable:
+                return True
+            
+            for d in dirs:
+                if d not in links and is_unsplitable_subfolder(d) and is_release(submit(os.path.join(root, d), stats and stats.get(d)).result()):
+                    return True
+            
+            return False
+        
+        stack = [(root_path, None, None)]
+        while stack:
+            for path, _, st in stack[-self.scan_prefetch * self.scan_workers:]: # the next directories to be yielded
+                submit(path, st)
+            
+            path, release, _ = stack.pop()
+            result = futures.pop(path).result()
+            if result is None:
+                continue
+            
+            root, dirs, files, links, signature, record, stats = result
+            if classify:
+                name = os.path.basename(root)
+                if not is_unsplitable_subfolder(name):
+                    if is_release(result):
+                        release = name
+                elif root == root_path and is_release(result): # the release starts above the path
+                    release = get_root_of_unsplitable(root.split(os.sep))
+            
+            yield root, dirs, files, links, signature, record, stats, release
+            
+            for d in reversed(dirs):
+                if d not in links: # os.walk does not follow links either
+                    stack.append((os.path.join(root, d), release, stats and stats.get(d)))
+    
+    def scan_paths(self, paths, incremental=False, stat_files=False, classify=False, stats=None):
+        """
+        Walks all paths concurrently and yields what walk yields, each path in walk order.
+        
+        The directories of the paths are yielded as they are scanned, so the directories
+        of different paths are interleaved and a slow path does not hold back the others.
+        
+        If stats is a list, a dict with scan statistics is appended to it for each path, in the order of paths.
+        """
+        executor = ThreadPoolExecutor(max_workers=self.scan_workers)
+        queue = Queue(SCAN_QUEUE_SIZE) # shared by the paths, the writer takes what is scanned first
+        
+        def producer(i, root_path):
+            try:
+                path_stats = {'path': root_path, 'directories': 0, 'files': 0, 'bytes': 0}
+                start_time = time.time()
+                for result in self.walk(root_path, executor, incremental, stat_files, classify):
+                    path_stats['directories'] += 1
+                    files, entry_stats = result[2], result[6]
+                    if entry_stats:
+                        for f in files:
+                            if f in entry_stats:
+                                path_stats['files'] += 1
+                                path_stats['bytes'] += entry_stats[f].st_size
+                    queue.put((i, result))
+                path_stats['seconds'] = time.time() - start_time
+                queue.put((i, path_stats))
+            except Exception as e:
+                queue.put((i, e))
+        
+        for i, root_path in enumerate(paths):
+            thread = threading.Thread(target=producer, args=(i, root_path))
+            thread.daemon = True
+            thread.start()
+        
+        try:
+            path_stats = {}
+            while len(path_stats) < len(paths):
+                i, result = queue.get()
+                if isinstance(result, Exception):
+                    raise result
+                
+                if isinstance(result, dict):
+                    path_stats[i] = result
+                    continue
+                
+                yield result
+            
+            if stats is not None:
+                stats += [path_stats[i] for i in range(len(paths))]
+        finally:
+            executor.shutdown(wait=False)
+    
+    def remove_directory(self, path):
+        """
+        Removes a directory, its subdirectories and all their files from the database.
+        """
+        storage = self.write_buffer or self.db
+        stack = [path]
+        while stack:
+            path = stack.pop()
+            record = storage.get_directory(path)
+            if not record:
+                continue
+            
+            logger.debug('Removing directory %r from database' % path)
+            for table, key, entry_path in record['entries']:
+                self.remove_entry(table, key, entry_path)
+            storage.remove_directory(path)
+            
+            stack += [os.path.join(path, d) for d in record['dirs']]
+    
+    def remove_entry(self, table, key, path):
+        """
+        Removes path from key in table, the single path keys removed are remembered in removed_keys.
+        """
+        storage = self.write_buffer or self.db
+        storage.remove(table, key, path)
+        if self.removed_keys is not None and table in SINGLE_TABLES:
+            self.removed_keys.add((table, key))
+    
+    def restore_removed_keys(self, roots):
+        """
+        Gives the single path keys removed by a rebuild, and not stored again, to the other files
+        with the same key that are found in the directory records below roots.
+        The files are picked like a full rebuild would, the last one found in the last path wins.
+        """
+        missing = set(table_key for table_key in self.removed_keys if self.db.get(*table_key) is None)
+        if not missing:
+            return
+        
+        logger.debug('Looking for other files with %i removed keys' % len(missing))
+        found = {}
+        for root in roots:
+            stack = [root]
+            while stack:
+                path = stack.pop()
+                record = self.db.get_directory(path)
+                if not record:
+                    continue
+                
+                for table, key, entry_path in record['entries']:
+                    if (table, key) in missing and os.path.isfile(entry_path):
+                        rank = self.get_path_rank(entry_path, self.path_roots)
+                        if (table, key) not in found or rank >= found[(table, key)][0]:
+                            found[(table, key)] = (rank, entry_path)
+                
+                stack += [os.path.join(path, d) for d in reversed(record['dirs']) if d not in record['links']]
+        
+        for (table, key), (_, path) in found.items():
+            logger.debug('Storing %r again under a removed key' % path)
+            self.db.add(table, key, path, size=os.path.getsize(path), name=self.normalize_filename(os.path.basename(path)))
+    
+    def rebuild(self, paths=None, incremental=False):
+        """
+        Scans the paths for files and rebuilds the database.
+        
+        With incremental, only directories changed since the last scan are
+        listed and their entries in the database replaced.
+        
+        The entries found are buffered and written to the storage in batches of write_batch_size.
+        The paths are scanned concurrently, a file found in a later path still wins over one with the
+        same key in an earlier path, see get_path_rank. The paths stored for a key in exact and hash modes
+        are ordered by path when they are looked up, see sort_paths.
+        """
+        self.remove_lookup_index()
+        scan_settings = self.get_scan_settings()
+        if incremental and self.db.get_meta('scan_settings') != scan_settings:
+            logger.info('Database was built with other settings or without directory records, doing a full rebuild')
+            incremental = False
+            paths = None
+        elif (incremental or paths) and self.key_format != self.db_key_format:
+            logger.info('Database was built with key format %s, doing a full rebuild' % self.key_format)
+            incremental = False
+            paths = None
+
+        self.removed_keys = set()
         if paths:
             logger.info('Just adding new paths')
+            scanned_paths = set(self.db.get_meta('scanned_paths', []))
+        elif incremental:
+            logger.info('Incrementally rebuilding database')
+            paths = self.paths
+            scanned_paths = set()
+            for path in set(self.db.get_meta('scanned_paths', [])) - set(os.path.abspath(p) for p in paths):
+                logger.info('Path %r is no longer configured, removing it from the database' % path)
+                self.remove_directory(path)
         else:
             logger.info('Rebuilding database')
             self.truncate()
+            self.set_key_format(self.db_key_format)
             paths = self.paths
+            scanned_paths = set()
         
-        unsplitable_paths = set()
-        if self.unsplitable_mode or self.exact_mode:
-            logger.info('Special modes enabled, doing a preliminary scan')
-            for root_path in paths:
-                logger.info('Preliminary scanning %s' % root_path)
-                for root, dirs, files in os.walk(root_path):
-                    if is_unsplitable(files):
-                        sep_root = root.split(os.sep)
-                        name = get_root_of_unsplitable(root.split(os.sep))
-                        while sep_root[-1] != name:
-                            sep_root.pop()
-                        path = os.path.join(*sep_root)
-                        logger.debug('Found unsplitable path %r' % path)
-                        unsplitable_paths.add(path)
-                logger.info('Done preliminary scanning %s' % root_path)
-        
-        for root_path in paths:
-            logger.info('Scanning %s' % root_path)
-            for root, dirs, files in os.walk(root_path):
-                unsplitable = False
-                if self.unsplitable_mode or self.exact_mode:
-                    sep_root = root.split(os.sep)
-                    while sep_root:
-                        if os.path.join(*sep_root) in unsplitable_paths:
-                            break
-                        sep_root.pop()
-                    
-                    if sep_root:
-                        unsplitable = True
-                        if self.unsplitable_mode:
-                            unsplitable_name = sep_root[-1]
-                            logger.info('Looks like we found a unsplitable release in %r' % (os.sep.join(sep_root)))
-                            for f in files:
-                                self.insert_into_database(root, f, 'unsplitable', unsplitable_name=unsplitable_name)
-                            continue
+        logger.info('Scanning paths')
+        scan_stats = []
+        self.write_buffer = WriteBuffer(self.db, self.write_batch_size, self.write_batch_memory)
+        self.scan_roots = [os.path.abspath(p) for p in paths]
+        try:
+            self._scan_into_database(paths, incremental, scan_stats)
+            self.write_buffer.flush()
+            logger.debug('Wrote entries to the storage in %i batches' % self.write_buffer.flushes)
+            
+            self.write_buffer = None
+            roots = set(scanned_paths) | set(self.scan_roots)
+            self.restore_removed_keys([root for root in self.path_roots if root in roots] + sorted(roots - set(self.path_roots)))
+        finally:
+            self.write_buffer = None
+            self.scan_roots = ()
+            self.removed_keys = None
+        
+        logger.info('Done scanning paths')
+        for path_stats in scan_stats:
+            logger.info('Scanned %(path)s: %(directories)i directories and %(files)i files with %(bytes)i bytes in %(seconds).1f seconds' % path_stats)
+        
+        self.db.set_meta('scanned_paths', sorted(scanned_paths | set(os.path.abspath(p) for p in paths)))
+        self.db.set_meta('scan_settings', scan_settings)
+        self.db.set_meta('key_format', self.key_format)
+        logger.info('Building size index')
+        token = uuid.uuid4().hex # always a new one, an index from an older build must not be used
+        SizeIndex.write(self.get_size_index_path(), token, self.db.get_sizes())
+        self.db.set_meta('hash_sizes_token', token)
+        self.db.sync()
+        
+        if self.lookup_index:
+            self.compile_lookup_index()
+        
+        return scan_stats
+    
+    def _scan_into_database(self, paths, incremental, scan_stats):
+        """
+        Scans the paths and inserts what is found through the write buffer.
+        """
+        classify = self.unsplitable_mode or self.exact_mode
+        for root, dirs, files, links, signature, record, stats, unsplitable_name in self.scan_paths(paths, incremental, True, classify, scan_stats):
+            unsplitable = unsplitable_name is not None
+            if files is None:
+                if record['release'] == unsplitable_name:
+                    continue
+                
+                logger.debug('Directory %r changed release, listing it again' % root)
+                listing = self.list_directory(root, True)
+                if listing is None:
+                    continue
+                dirs, files, links, stats = listing
+            
+            if record:
+                for table, key, entry_path in record['entries']:
+                    self.remove_entry(table, key, entry_path)
                 
+                for d in set(record['dirs']) - set(dirs):
+                    self.remove_directory(os.path.join(root, d))
+            
+            entries = []
+            if unsplitable and self.unsplitable_mode:
+                logger.info('Looks like we found a unsplitable release %r in %r' % (unsplitable_name, root))
+                for f in files:
+                    entries.append(self.insert_into_database(root, f, 'unsplitable', unsplitable_name=unsplitable_name, stats=stats))
+            else:
                 if not unsplitable:
                     if self.normal_mode:
                         for f in files:
                             if self.skip_file(f):
                                 continue
                             
-                            self.insert_into_database(root, f, 'normal')
+                            entries.append(self.insert_into_database(root, f, 'normal', stats=stats))
                         
                     if self.exact_mode:
                         for f in files:
-                            self.insert_into_database(root, f, 'exact', 'f')
+                            entries.append(self.insert_into_database(root, f, 'exact', 'f', stats=stats))
                         
                         for d in dirs:
-                            self.insert_into_database(root, d, 'exact', 'd')
+                            entries.append(self.insert_into_database(root, d, 'exact', 'd', stats=stats))
                 
                 if self.hash_name_mode or self.hash_size_mode or self.hash_slow_mode:
                     for f in files:
                         if self.hash_size_mode or self.hash_slow_mode:
-                            self.insert_into_database(root, f, 'hash_store_size')
+                            entries.append(self.insert_into_database(root, f, 'hash_store_size', stats=stats))
                         
                         if self.hash_name_mode:
-                            self.insert_into_database(root, f, 'hash_store_name')
-
-                    
-            logger.info('Done scanning %s' % root_path)
-        self.db.sync()
+                            entries.append(self.insert_into_database(root, f, 'hash_store_name', stats=stats))
+            
+            self.write_buffer.set_directory(root, {
+                'signature': signature,
+                'dirs': dirs,
+                'links': links,
+                'unsplitable': is_unsplitable(files),
+                'release': unsplitable_name,
+                'entries': [entry for entry in entries if entry],
+            })
     
     def clear_hash_size_table(self):
         """
         Clears the hash size table.
         """
+        if isinstance(self.hash_size_table, SizeIndex):
+            self.hash_size_table.close()
         self.hash_size_table = None
     
+    def get_size_index_path(self):
+        """
+        Returns the path of the size index stored next to the database.
+        """
+        return '%s.sizes' % self.db_file
+    
     def build_hash_size_table(self):
         """
-        Builds a table of all sizes to make lookups faster for varying sizes.
+        Loads the sorted table of all sizes to make lookups faster for varying sizes.
+        
+        The table is stored next to the database when it is rebuilt. If it is missing or
+        does not belong to the current database, the database is scanned for it.
         """
         if self.hash_size_table is not None:
             logger.debug('Hash size table already built, skipping')
             return
         
-        self.hash_size_table = set()
-        for key in self.db.keys():
-            if not key.startswith('s:'):
-                continue
-            
-            _, size = key.split(':')
-            self.hash_size_table.add(int(size))
+        if self.index is not None:
+            self.hash_size_table = self.index.get_sizes()
+            return
         
-        self.hash_size_table = sorted(self.hash_size_table)
+        self.hash_size_table = SizeIndex.open(self.get_size_index_path(), self.db.get_meta('hash_sizes_token'))
+        if self.hash_size_table is None:
+            logger.info('No usable size index, building hash size table')
+            self.hash_size_table = array(SIZE_TYPECODE, self.db.get_sizes())
     
     def find_hash_varying_size(self, size):
         """
@@ -211,21 +763,13 @@ class Database(object):
         size_span = size * self.hash_mode_size_varying / 100
         min_size_span, max_size_span = size - size_span, size + size_span
         
-        found_sizes = []
-        for db_size in self.hash_size_table:
-            if db_size < min_size_span:
-                continue
-            
-            if db_size > max_size_span:
-                break
-            
-            found_sizes.append(db_size)
+        start = bisect_left(self.hash_size_table, min_size_span)
+        end = bisect_right(self.hash_size_table, max_size_span, start)
         
-        found_sizes = sorted(found_sizes, key=lambda x:abs(x-size))
+        found_sizes = sorted(self.hash_size_table[start:end], key=lambda x:abs(x-size))
         result = []
         for found_size in found_sizes:
-            key = str('s:%i' % found_size)
-            result += self.db.get(key, [])
+            result += self.lookup('hash_size', found_size)
         
         return result
     
@@ -235,7 +779,10 @@ class Database(object):
         
         Returns a list of paths.
         """
-        return self.db.get(str('s:%s' % size), [])
+        return self.lookup('hash_size', size)
+    
+    def get_hash_name_key(self, f):
+        return self.keyify(self.normalize_filename(f))
     
     def find_hash_name(self, f):
         """
@@ -243,46 +790,101 @@ class Database(object):
         
         Returns a list of paths.
         """
-        key = self.keyify(self.normalize_filename(f))
-        
-        return self.db.get(key, [])
+        return self.lookup('hash_name', self.get_hash_name_key(f))
+    
+    def get_unsplitable_file_path_key(self, rls, f, size):
+        f = [self.normalize_filename(x) for x in f]
+        return self.keyify(size, self.normalize_filename(rls), *f)
     
     def find_unsplitable_file_path(self, rls, f, size):
         """
         Looks for a file in the database.
         """
-        f = [self.normalize_filename(x) for x in f]
-        key = self.keyify(size, self.normalize_filename(rls), *f)
-
-        return self.db.get(key)
+        return self.lookup('unsplitable', self.get_unsplitable_file_path_key(rls, f, size))
+    
+    def get_exact_file_path_key(self, prefix, rls):
+        return self.keyify(prefix, rls)
     
     def find_exact_file_path(self, prefix, rls):
         """
         Looks for a name in the database.
         """
-        key = self.keyify(prefix, rls)
-
-        return self.db.get(key)
+        return self.lookup('exact', self.get_exact_file_path_key(prefix, rls)) or None
+    
+    def get_file_path_key(self, f, size):
+        return self.keyify(size, self.normalize_filename(f))
     
     def find_file_path(self, f, size):
         """
         Looks for a file in the database.
         """
-        key = self.keyify(size, self.normalize_filename(f))
-
-        return self.db.get(key)
+        return self.lookup('normal', self.get_file_path_key(f, size))
+    
+    def find_many(self, requests):
+        """
+        Does many lookups at once, the keys of each table are looked up together.
+        
+        requests is a list of (kind, args) where kind is one of FIND_KINDS and args the
+        arguments of the find method of that kind, e.g. ('file_path', (f, size)).
+        Returns what the find methods return, in the order of requests.
+        """
+        table_keys = {}
+        request_keys = []
+        for kind, args in requests:
+            table = FIND_KINDS[kind]
+            key = args[0] if kind == 'hash_size' else getattr(self, 'get_%s_key' % kind)(*args)
+            table_keys.setdefault(table, []).append(key)
+            request_keys.append((table, key))
+        
+        found = dict((table, self.lookup_many(table, keys)) for table, keys in table_keys.items())
+        
+        result = []
+        for (kind, _), (table, key) in zip(requests, request_keys):
+            value = found[table][key]
+            if kind == 'exact_file_path':
+                value = value or None
+            result.append(value)
+        return result
+    
+    def set_key_format(self, key_format):
+        """
+        Changes how keys are made, the database must be rebuilt to use them.
+        """
+        self.key_format = key_format
+        self._key_cache = None
     
     def keyify(self, size, *names):
         """
         Turns a name and size into a key that can be stored in the database.
-        """
+        
+        The keys are remembered, the same names are looked up for every torrent
+        with the file and for every scan mode.
+        """
+        cache_key = (size, ) + names
+        if self._key_cache is None or len(self._key_cache) >= KEY_CACHE_SIZE:
+            self._key_cache = {}
+        elif cache_key in self._key_cache:
+            return self._key_cache[cache_key]
+        
         key = '%s|%s' % (size, '|'.join(names))
-        logger.debug('Keyify: %s' % key)
+        logger.debug('Keyify: %s', key)
         
-        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+        if self.key_format == 'sha256':
+            key = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        else: # a file name cannot make the key look like the prefixed keys of the storage, e.g. s:5| in the shelve
+            key = PLAIN_KEY_PREFIX + key
+        
+        self._key_cache[cache_key] = key
+        return key
     
     def normalize_filename(self, filename):
         """
         Normalizes a filename to better detect simlar files.
         """
-        return filename.replace(' ', '_').lower()
+        if self._normalize_cache is None or len(self._normalize_cache) >= KEY_CACHE_SIZE:
+            self._normalize_cache = {}
+        elif filename in self._normalize_cache:
+            return self._normalize_cache[filename]
+        
+        normalized_filename = self._normalize_cache[filename] = filename.replace(' ', '_').lower()
+        return normalized_filename
@@ -0,0 +1,276 @@
+from __future__ import unicode_literals
+
+import logging
+import mmap
+import os
+import struct
+import sys
+
+from array import array
+
+import six
+
+logger = logging.getLogger(__name__)
+
+try:
+    SIZE_TYPECODE = str('Q')
+    array(SIZE_TYPECODE)
+except ValueError: # python 2 has no unsigned long long, long is 64 bit on the platforms supported
+    SIZE_TYPECODE = str('L')
+
+PATH_ERRORS = 'surrogateescape' if six.PY3 else 'strict' # undecodable filenames are kept as surrogates on python 3
+
+
+def write_uint64s(f, values):
+    """
+    Writes values to f as little endian unsigned 64 bit integers.
+    """
+    values = array(SIZE_TYPECODE, values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    values.tofile(f)
+
+
+class SizeIndex(object):
+    """
+    A sorted list of sizes stored in a file as unsigned 64 bit integers.
+    The file is memory mapped, so only the parts searched are read.
+
+    The header has a token that must match the token stored in the database,
+    a new token is made every time the database is rebuilt.
+    """
+    MAGIC = b'ATSZ'
+    HEADER = struct.Struct(str('<4s32sQ')) # magic, token, number of sizes
+    SIZE = struct.Struct(str('<Q'))
+
+    def __init__(self, f, token):
+        """
+        Opens the index in the file object f, raises ValueError if it is not a valid index for token.
+        """
+        self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mmap) < self.HEADER.size:
+            raise ValueError('File is too short to be a size index')
+
+        magic, file_token, self.count = self.HEADER.unpack_from(self.mmap, 0)
+        if magic != self.MAGIC or file_token != token.encode('ascii'):
+            raise ValueError('Size index does not match the database')
+
+        if len(self.mmap) != self.HEADER.size + self.count * self.SIZE.size:
+            raise ValueError('Size index is truncated')
+
+    @classmethod
+    def open(cls, path, token):
+        """
+        Returns the index found at path or None if it does not exist or is out of date.
+        """
+        if token is None or not os.path.isfile(path):
+            return None
+
+        try:
+            with open(path, 'rb') as f:
+                return cls(f, token)
+        except (ValueError, EnvironmentError) as e:
+            logger.info('Unable to use size index %r: %s' % (path, e))
+            return None
+
+    @classmethod
+    def write(cls, path, token, sizes):
+        """
+        Writes the sorted sizes to path, the file is replaced atomically.
+        """
+        tmp_path = '%s.tmp%i' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, token.encode('ascii'), len(sizes)))
+            write_uint64s(f, sizes)
+        os.rename(tmp_path, path)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.count)
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            count = max(stop - start, 0)
+            return list(struct.unpack_from(str('<%iQ' % count), self.mmap, self.HEADER.size + start * self.SIZE.size))
+
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('size index out of range')
+        return self.SIZE.unpack_from(self.mmap, self.HEADER.size + index * self.SIZE.size)[0]
+
+    def close(self):
+        self.mmap.close()
+
+
+class LookupIndex(object):
+    """
+    A read-only copy of the database tables compiled into one memory mapped file.
+    Lookups are binary searches in the mapped file, nothing is unpickled.
+
+    For every table the file has the sorted keys and the paths stored under them,
+    each with a list of offsets into a blob:
+      key offsets - count + 1 little endian uint64
+      keys        - the utf-8 encoded keys, sizes are zero padded
+      path offsets - count + 1 little endian uint64
+      paths       - the utf-8 encoded paths of each key, separated by a null byte
+    """
+    MAGIC = b'ATLX'
+    VERSION = 1
+    HEADER = struct.Struct(str('<4sI16sI')) # magic, version, key format, number of tables
+    TABLE = struct.Struct(str('<16sQQQQQ')) # name, number of keys, positions of key offsets, keys, path offsets and paths
+    OFFSETS = struct.Struct(str('<QQ'))
+
+    def __init__(self, f):
+        """
+        Opens the index in the file object f, raises ValueError if it is not a valid index.
+        """
+        self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mmap) < self.HEADER.size:
+            raise ValueError('File is too short to be a lookup index')
+
+        magic, version, key_format, table_count = self.HEADER.unpack_from(self.mmap, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError('File is not a lookup index of a known version')
+
+        self.key_format = key_format.rstrip(b'\0').decode('ascii')
+        self.tables = {}
+        for i in range(table_count):
+            table = self.TABLE.unpack_from(self.mmap, self.HEADER.size + i * self.TABLE.size)
+            self.tables[table[0].rstrip(b'\0').decode('ascii')] = table[1:]
+
+    @classmethod
+    def open(cls, path):
+        """
+        Returns the index found at path or None if it does not exist or cannot be used.
+        """
+        if not os.path.isfile(path):
+            return None
+
+        try:
+            with open(path, 'rb') as f:
+                return cls(f)
+        except (ValueError, EnvironmentError, struct.error) as e:
+            logger.warning('Unable to use lookup index %r: %s' % (path, e))
+            return None
+
+    @staticmethod
+    def encode_key(key):
+        if isinstance(key, six.integer_types):
+            return ('%020i' % key).encode('ascii')
+        return key.encode('utf-8')
+
+    @classmethod
+    def write(cls, path, key_format, tables):
+        """
+        Writes an index to path, the file is replaced atomically.
+
+        tables is a dict of table name to an iterable of (key, paths) where paths
+        is a path or a list of paths.
+        """
+        sections = []
+        for name, items in tables.items():
+            entries = []
+            for key, paths in items:
+                if not paths:
+                    continue
+                if not isinstance(paths, list):
+                    paths = [paths]
+                entries.append((cls.encode_key(key), b'\0'.join(p.encode('utf-8', PATH_ERRORS) for p in paths)))
+            entries.sort()
+            sections.append((name, entries))
+
+        tmp_path = '%s.tmp%i' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, key_format.encode('ascii'), len(sections)))
+
+            position = cls.HEADER.size + len(sections) * cls.TABLE.size
+            blobs = []
+            for name, entries in sections:
+                positions = []
+                for blob in (x[0] for x in entries), (x[1] for x in entries):
+                    offsets, data = [0], []
+                    for value in blob:
+                        data.append(value)
+                        offsets.append(offsets[-1] + len(value))
+                    positions += [position, position + len(offsets) * 8]
+                    position += len(offsets) * 8 + offsets[-1]
+                    blobs.append((offsets, data))
+                f.write(cls.TABLE.pack(name.encode('ascii'), len(entries), *positions))
+
+            for offsets, data in blobs:
+                write_uint64s(f, offsets)
+                f.write(b''.join(data))
+        os.rename(tmp_path, path)
+
+    def _item(self, offsets_position, data_position, index):
+        start, end = self.OFFSETS.unpack_from(self.mmap, offsets_position + index * 8)
+        return self.mmap[data_position + start:data_position + end]
+
+    def _find(self, table, key):
+        """
+        Returns the encoded paths stored under key in table or None.
+        """
+        if table not in self.tables:
+            return None
+
+        count, key_offsets, keys, path_offsets, paths = self.tables[table]
+        key = self.encode_key(key)
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if self._item(key_offsets, keys, middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < count and self._item(key_offsets, keys, low) == key:
+            return self._item(path_offsets, paths, low)
+        return None
+
+    def get(self, table, key, single=False):
+        """
+        Returns the path stored under key when single is true (or None),
+        otherwise a list of paths.
+        """
+        value = self._find(table, key)
+        if value is None:
+            return None if single else []
+
+        paths = [p.decode('utf-8', PATH_ERRORS) for p in value.split(b'\0')]
+        return paths[-1] if single else paths
+
+    def get_sizes(self):
+        """
+        Returns a sorted sequence of the distinct sizes in the hash_size table.
+        """
+        return KeySizes(self, *self.tables.get('hash_size', (0, 0, 0, 0, 0))[:3])
+
+    def close(self):
+        self.mmap.close()
+
+
+class KeySizes(object):
+    """
+    The keys of a table in a LookupIndex as integers, can be searched with bisect.
+    """
+    def __init__(self, index, count, key_offsets, keys):
+        self.index = index
+        self.count = count
+        self.key_offsets = key_offsets
+        self.keys = keys
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.count))]
+
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('size index out of range')
+        return int(self.index._item(self.key_offsets, self.keys, index))
@@ -0,0 +1,174 @@
+from __future__ import division
+
+import errno
+import logging
+import os
+import struct
+
+from collections import defaultdict
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024 # bytes copied at a time when the data goes through python
+FICLONERANGE = 0x4020940d # _IOW(0x94, 13, struct file_clone_range) from linux/fs.h
+
+UNSUPPORTED_ERRORS = set(getattr(errno, name) for name in ['EXDEV', 'EINVAL', 'ENOSYS', 'ENOTTY', 'ENOTSOCK',
+                                                             'EOPNOTSUPP', 'ENOTSUP', 'EBADF'] if hasattr(errno, name))
+
+
+class FileCopier(object):
+    """
+    Copies ranges of data between two open files, with the fastest way the system supports:
+    cloning the extents (FICLONERANGE), copy_file_range, sendfile or reading and writing.
+
+    A way that fails as unsupported is not tried again by the copier.
+    The number of bytes handled by each way is counted in methods.
+    """
+    def __init__(self, source_fd, destination_fd, clone=True):
+        self.source_fd = source_fd
+        self.destination_fd = destination_fd
+        self.block_size = getattr(os.fstat(destination_fd), 'st_blksize', 0) or 4096
+        self.can_clone = clone and fcntl is not None
+        self.can_copy_file_range = hasattr(os, 'copy_file_range')
+        self.can_sendfile = hasattr(os, 'sendfile')
+        self.methods = defaultdict(int)
+
+    def _unsupported(self, method, e):
+        if e.errno not in UNSUPPORTED_ERRORS:
+            raise e
+        logger.debug('Unable to use %s, falling back: %s', method, e)
+
+    def _write(self, destination_offset, data):
+        os.lseek(self.destination_fd, destination_offset, os.SEEK_SET)
+        data = memoryview(data)
+        while data:
+            data = data[os.write(self.destination_fd, data):]
+
+    def copy(self, source_offset, destination_offset, count):
+        """
+        Copies count bytes from source_offset in the source to destination_offset in the destination.
+        Returns the number of bytes copied, less than count if the source ended.
+        """
+        logger.debug('Copying %i bytes from %i to %i', count, source_offset, destination_offset)
+        copied = 0
+        if self.can_clone and count > 0 and (source_offset - destination_offset) % self.block_size == 0:
+            head = min((-destination_offset) % self.block_size, count) # cloning must start on a block
+            copied += self.copy_data(source_offset, destination_offset, head)
+
+            aligned = (count - head) - (count - head) % self.block_size
+            if copied == head and aligned and self.clone(source_offset + head, destination_offset + head, aligned):
+                copied += aligned
+
+        return copied + self.copy_data(source_offset + copied, destination_offset + copied, count - copied)
+
+    def clone(self, source_offset, destination_offset, count):
+        """
+        Makes the destination share the extents with the source, offsets and count must be block aligned.
+        Returns True if it was done.
+        """
+        try:
+            fcntl.ioctl(self.destination_fd, FICLONERANGE,
+                        struct.pack(str('qQQQ'), self.source_fd, source_offset, count, destination_offset))
+        except (IOError, OSError) as e:
+            self._unsupported('FICLONERANGE', e)
+            self.can_clone = False
+            return False
+
+        self.methods['clone'] += count
+        return True
+
+    def copy_data(self, source_offset, destination_offset, count):
+        """
+        Copies data without cloning, returns the number of bytes copied.
+        """
+        copied = 0
+        while copied < count:
+            result = None
+            if self.can_copy_file_range:
+                try:
+                    result = os.copy_file_range(self.source_fd, self.destination_fd, count - copied,
+                                                source_offset + copied, destination_offset + copied)
+                    method = 'copy_file_range'
+                except OSError as e:
+                    self._unsupported('copy_file_range', e)
+                    self.can_copy_file_range = False
+
+            if result is None and self.can_sendfile:
+                try:
+                    os.lseek(self.destination_fd, destination_offset + copied, os.SEEK_SET)
+                    result = os.sendfile(self.destination_fd, self.source_fd, source_offset + copied, count - copied)
+                    method = 'sendfile'
+                except OSError as e:
+                    self._unsupported('sendfile', e)
+                    self.can_sendfile = False
+
+            if result is None:
+                os.lseek(self.source_fd, source_offset + copied, os.SEEK_SET)
+                data = os.read(self.source_fd, min(CHUNK_SIZE, count - copied))
+                self._write(destination_offset + copied, data)
+                result = len(data)
+                method = 'read'
+
+            if not result: # the source ended
+                break
+
+            copied += result
+            self.methods[method] += result
+
+        return copied
+
+    def write_zeros(self, destination_offset, count, sparse=False):
+        """
+        Writes count zero bytes at destination_offset.
+
+        If sparse is true and the zeros are after the end of the destination, the file
+        is extended instead, leaving a hole on filesystems that support sparse files.
+        """
+        if sparse and os.fstat(self.destination_fd).st_size <= destination_offset:
+            logger.debug('Leaving a hole of %i bytes at %i', count, destination_offset)
+            os.ftruncate(self.destination_fd, destination_offset + count)
+            self.methods['hole'] += count
+            return
+
+        logger.debug('Writing %i zero bytes at %i', count, destination_offset)
+        zeros = b'\x00' * min(CHUNK_SIZE, count)
+        written = 0
+        while written < count:
+            chunk = min(len(zeros), count - written)
+            self._write(destination_offset + written, zeros[:chunk])
+            written += chunk
+        self.methods['zeros'] += count
+
+
+def rewrite_file(source, destination, action, point, diff, clone=True, sparse=True):
+    """
+    Writes the file source to destination with diff bytes removed or
+    zero bytes added at point, action is either 'remove' or 'add'.
+
+    Only the modification goes through python, the rest is copied with a FileCopier.
+    When sparse is true the added bytes are left as a hole instead of being written.
+    Returns the FileCopier used.
+    """
+    size = os.path.getsize(source)
+    with open(source, 'rb') as source_fp:
+        with open(destination, 'wb') as destination_fp:
+            copier = FileCopier(source_fp.fileno(), destination_fp.fileno(), clone)
+            if point > size:
+                logger.debug('The breakpoint is after the end of %r, copying it as it is' % source)
+                copier.copy(0, 0, size)
+                return copier
+
+            copier.copy(0, 0, point)
+            if action == 'remove':
+                copier.copy(point + diff, point, max(size - point - diff, 0))
+            elif action == 'add':
+                copier.write_zeros(point, diff, sparse)
+                copier.copy(point, point + diff, size - point)
+
+    logger.debug('Rewrote %r to %r: %r' % (source, destination, dict(copier.methods)))
+    return copier
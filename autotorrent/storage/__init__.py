@@ -0,0 +1,19 @@
+import logging
+
+from ._base import BaseStorage
+from .buffer import WriteBuffer
+from .shelf import ShelveStorage
+
+logger = logging.getLogger(__name__)
+
+STORAGE_BACKENDS = {}
+
+STORAGE_BACKENDS[ShelveStorage.identifier] = ShelveStorage
+
+try:
+    from .sqlite import SQLiteStorage
+    STORAGE_BACKENDS[SQLiteStorage.identifier] = SQLiteStorage
+
+    logger.debug('Enabled storage %s' % SQLiteStorage.identifier)
+except ImportError:
+    logger.debug('Failed to enable storage sqlite')
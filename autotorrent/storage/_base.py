@@ -0,0 +1,146 @@
+import functools
+
+SINGLE_TABLES = ('normal', 'unsplitable') # one path per key, newest insert wins
+LIST_TABLES = ('exact', 'hash_name', 'hash_size') # a list of paths per key
+TABLES = SINGLE_TABLES + LIST_TABLES
+
+
+def synchronized(f):
+    """
+    Serializes calls to a storage method, the scan workers read from
+    the storage while the database writes to it.
+    """
+    @functools.wraps(f)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return f(self, *args, **kwargs)
+    return wrapper
+
+
+class BaseStorage(object):
+    identifier = None # used to identify it in the config file
+    file_suffix = '' # added to the configured path so backends never open each other's file
+
+    def __init__(self, path):
+        """
+        Opens the storage found at path, creating it if it does not exist.
+
+        Implementations must set self.lock and wrap their methods with synchronized.
+        """
+        raise NotImplementedError
+
+    def truncate(self):
+        """
+        Removes everything from the storage.
+        """
+        raise NotImplementedError
+
+    def sync(self):
+        """
+        Makes sure everything written is persisted.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Closes the storage, it cannot be used afterwards.
+        """
+        raise NotImplementedError
+
+    def add(self, table, key, path, size=None, name=None):
+        """
+        Stores path under key in table. For the hash_size table, the key is the size.
+
+        size and name are the size and normalized filename of path, when known.
+        """
+        raise NotImplementedError
+
+    def add_many(self, table, entries):
+        """
+        Stores a list of (key, path, size, name) tuples in table, like calling add for each.
+        """
+        for key, path, size, name in entries:
+            self.add(table, key, path, size, name)
+
+    def remove(self, table, key, path):
+        """
+        Removes path stored under key in table, other paths with same key are kept.
+        """
+        raise NotImplementedError
+
+    def remove_many(self, table, entries):
+        """
+        Removes a list of (key, path) tuples from table, like calling remove for each.
+        """
+        for key, path in entries:
+            self.remove(table, key, path)
+
+    def get(self, table, key):
+        """
+        Returns the path stored under key for single-path tables (or None)
+        and a list of paths for list tables.
+        """
+        raise NotImplementedError
+
+    def get_many(self, table, keys):
+        """
+        Returns a dict of every key in keys to what get returns for it.
+        """
+        return dict((key, self.get(table, key)) for key in keys)
+
+    def keys(self, table):
+        """
+        Returns an iterable of the distinct keys in table.
+        """
+        raise NotImplementedError
+
+    def get_sizes(self, min_size=None, max_size=None):
+        """
+        Returns a sorted list of the distinct sizes in the hash_size table,
+        optionally limited to the range min_size to max_size (both inclusive).
+        """
+        raise NotImplementedError
+
+    def get_meta(self, key, default=None):
+        """
+        Returns a value stored with set_meta.
+        """
+        raise NotImplementedError
+
+    def set_meta(self, key, value):
+        """
+        Stores a picklable value, e.g. settings used when the database was built.
+        """
+        raise NotImplementedError
+
+    def get_directory(self, path):
+        """
+        Returns the scan record for directory path or None.
+        """
+        raise NotImplementedError
+
+    def set_directory(self, path, record):
+        """
+        Stores the scan record for directory path.
+        """
+        raise NotImplementedError
+
+    def set_directories(self, records):
+        """
+        Stores a list of (path, record) tuples, like calling set_directory for each.
+        """
+        for path, record in records:
+            self.set_directory(path, record)
+
+    def remove_directory(self, path):
+        """
+        Removes the scan record for directory path, not the files found in it.
+        """
+        raise NotImplementedError
+
+    def remove_directories(self, paths):
+        """
+        Removes the scan records for a list of directory paths, like calling remove_directory for each.
+        """
+        for path in paths:
+            self.remove_directory(path)
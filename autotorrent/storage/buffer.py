@@ -0,0 +1,144 @@
+from __future__ import absolute_import, unicode_literals
+
+import logging
+
+from collections import OrderedDict
+
+from ._base import SINGLE_TABLES, LIST_TABLES
+
+logger = logging.getLogger(__name__)
+
+ENTRY_OVERHEAD = 200 # rough number of bytes used to buffer an entry, besides its path
+
+
+class WriteBuffer(object):
+    """
+    Collects writes to a storage in memory and writes them to it in batches, a batch per table.
+
+    Removes are written before adds. A remove drops the pending add of the same entry,
+    so the storage ends up as if everything was written in the order it was called.
+
+    Pending single-path keys and directory records are read from the buffer,
+    everything else writes the pending batches before touching the storage.
+    """
+    def __init__(self, storage, batch_size=10000, memory_limit=64 * 1024 * 1024):
+        """
+        batch_size is the number of buffered entries and directory records that triggers a write,
+        memory_limit is the estimated number of bytes that does the same.
+        """
+        self.storage = storage
+        self.batch_size = batch_size
+        self.memory_limit = memory_limit
+        self.flushes = 0
+        self._reset()
+
+    def _reset(self):
+        self.single_tables = dict((table, {}) for table in SINGLE_TABLES) # newest insert wins anyway
+        self.list_tables = dict((table, OrderedDict()) for table in LIST_TABLES) # (key, path): (size, name)
+        self.directories = {}
+        self.removed = dict((table, set()) for table in SINGLE_TABLES + LIST_TABLES) # (key, path)
+        self.removed_directories = set()
+        self.count = 0
+        self.memory = 0
+
+    def _added(self, count, memory):
+        self.count += count
+        self.memory += memory
+        if self.count >= self.batch_size or self.memory >= self.memory_limit:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes everything buffered to the storage.
+        """
+        if not self.count:
+            return
+
+        logger.debug('Writing %i buffered entries to the storage' % self.count)
+        for table, entries in self.removed.items():
+            if entries:
+                self.storage.remove_many(table, list(entries))
+
+        if self.removed_directories:
+            self.storage.remove_directories(list(self.removed_directories))
+
+        for table, entries in self.single_tables.items():
+            if entries:
+                self.storage.add_many(table, [(key, ) + value for key, value in entries.items()])
+
+        for table, entries in self.list_tables.items():
+            if entries:
+                self.storage.add_many(table, [key_path + value for key_path, value in entries.items()])
+
+        if self.directories:
+            self.storage.set_directories(list(self.directories.items()))
+
+        self.flushes += 1
+        self._reset()
+
+    def add(self, table, key, path, size=None, name=None):
+        if table in SINGLE_TABLES:
+            self.single_tables[table][key] = (path, size, name)
+        else:
+            self.list_tables[table][(key, path)] = (size, name)
+        self._added(1, len(path) + ENTRY_OVERHEAD)
+
+    def remove(self, table, key, path):
+        if table in SINGLE_TABLES:
+            value = self.single_tables[table].get(key)
+            if value is not None and value[0] == path:
+                del self.single_tables[table][key]
+        else:
+            self.list_tables[table].pop((key, path), None)
+        self.removed[table].add((key, path))
+        self._added(1, len(path) + ENTRY_OVERHEAD)
+
+    def get(self, table, key):
+        if table not in SINGLE_TABLES:
+            self.flush()
+            return self.storage.get(table, key)
+
+        value = self.single_tables[table].get(key)
+        if value is not None:
+            return value[0]
+
+        path = self.storage.get(table, key)
+        if (key, path) in self.removed[table]:
+            return None
+        return path
+
+    def get_many(self, table, keys):
+        if table not in SINGLE_TABLES:
+            self.flush()
+            return self.storage.get_many(table, keys)
+
+        pending, missing = {}, []
+        for key in keys:
+            value = self.single_tables[table].get(key)
+            if value is not None:
+                pending[key] = value[0]
+            else:
+                missing.append(key)
+
+        result = self.storage.get_many(table, missing)
+        for key, path in result.items():
+            if (key, path) in self.removed[table]:
+                result[key] = None
+        result.update(pending)
+        return result
+
+    def get_directory(self, path):
+        if path in self.directories:
+            return self.directories[path]
+        if path in self.removed_directories:
+            return None
+        return self.storage.get_directory(path)
+
+    def set_directory(self, path, record):
+        self.directories[path] = record
+        self._added(1, len(path) + ENTRY_OVERHEAD * (len(record.get('entries', [])) + 1))
+
+    def remove_directory(self, path):
+        self.directories.pop(path, None)
+        self.removed_directories.add(path)
+        self._added(1, len(path) + ENTRY_OVERHEAD)
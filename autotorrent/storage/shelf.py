@@ -0,0 +1,173 @@
+from __future__ import absolute_import, unicode_literals
+
+import hashlib
+import shelve
+import threading
+
+from ._base import BaseStorage, synchronized, LIST_TABLES
+
+
+class ShelveStorage(BaseStorage):
+    """
+    Storage using a shelve, all tables share one key-value namespace.
+    """
+    identifier = 'shelve'
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.shelf = self.open_shelf()
+
+    def open_shelf(self, flag='c'):
+        return shelve.open(self.path, flag=flag)
+
+    def _key(self, table, key):
+        if table == 'hash_size':
+            return str('s:%i' % key)
+        return key
+
+    def _hashed_key(self, prefix, value):
+        return str('%s:%s' % (prefix, hashlib.sha256(value.encode('utf-8')).hexdigest()))
+
+    @synchronized
+    def truncate(self):
+        self.shelf.close()
+        self.shelf = self.open_shelf(flag='n')
+
+    @synchronized
+    def sync(self):
+        self.shelf.sync()
+
+    @synchronized
+    def close(self):
+        self.shelf.close()
+
+    @synchronized
+    def add(self, table, key, path, size=None, name=None):
+        key = self._key(table, key)
+        if table in LIST_TABLES:
+            self.shelf[key] = self.shelf.get(key, []) + [path]
+        else:
+            self.shelf[key] = path
+
+    @synchronized
+    def add_many(self, table, entries):
+        if table not in LIST_TABLES:
+            for key, path, size, name in entries:
+                self.shelf[self._key(table, key)] = path
+            return
+
+        paths = {}
+        for key, path, size, name in entries: # one read and write of the pickled list per key
+            paths.setdefault(self._key(table, key), []).append(path)
+
+        for key, key_paths in paths.items():
+            self.shelf[key] = self.shelf.get(key, []) + key_paths
+
+    @synchronized
+    def remove(self, table, key, path):
+        key = self._key(table, key)
+        value = self.shelf.get(key)
+        if table in LIST_TABLES:
+            if value is None:
+                return
+
+            value = [x for x in value if x != path]
+            if value:
+                self.shelf[key] = value
+            else:
+                del self.shelf[key]
+        elif value == path:
+            del self.shelf[key]
+
+    @synchronized
+    def remove_many(self, table, entries):
+        paths = {}
+        for key, path in entries: # one read and write of the stored value per key
+            paths.setdefault(self._key(table, key), set()).add(path)
+
+        for key, key_paths in paths.items():
+            value = self.shelf.get(key)
+            if value is None:
+                continue
+
+            if table in LIST_TABLES:
+                value = [x for x in value if x not in key_paths]
+                if value:
+                    self.shelf[key] = value
+                    continue
+            elif value not in key_paths:
+                continue
+            del self.shelf[key]
+
+    @synchronized
+    def get(self, table, key):
+        key = self._key(table, key)
+        if table in LIST_TABLES:
+            return self.shelf.get(key, [])
+        return self.shelf.get(key)
+
+    @synchronized
+    def get_many(self, table, keys):
+        result = {}
+        for key in sorted(set(keys)): # neighbouring keys are near each other on disk
+            result[key] = self.get(table, key)
+        return result
+
+    @synchronized
+    def keys(self, table):
+        if table == 'hash_size':
+            return self.get_sizes()
+
+        keys = set() # the tables share the namespace, the directory records know which table a key is in
+        for key in self.shelf.keys():
+            if key.startswith('d:'):
+                keys.update(entry[1] for entry in self.shelf[key]['entries'] if entry[0] == table)
+        return keys
+
+    @synchronized
+    def get_sizes(self, min_size=None, max_size=None):
+        sizes = set()
+        for key in self.shelf.keys():
+            if not key.startswith('s:'):
+                continue
+
+            size = int(key.split(':')[1])
+            if min_size is not None and size < min_size:
+                continue
+
+            if max_size is not None and size > max_size:
+                continue
+
+            sizes.add(size)
+
+        return sorted(sizes)
+
+    @synchronized
+    def get_meta(self, key, default=None):
+        return self.shelf.get(str('m:%s' % key), default)
+
+    @synchronized
+    def set_meta(self, key, value):
+        self.shelf[str('m:%s' % key)] = value
+
+    @synchronized
+    def get_directory(self, path):
+        return self.shelf.get(self._hashed_key('d', path))
+
+    @synchronized
+    def set_directory(self, path, record):
+        self.shelf[self._hashed_key('d', path)] = record
+
+    @synchronized
+    def remove_directory(self, path):
+        key = self._hashed_key('d', path)
+        if key in self.shelf:
+            del self.shelf[key]
+
+    @synchronized
+    def remove_directories(self, paths):
+        for path in paths:
+            key = self._hashed_key('d', path)
+            if key in self.shelf:
+                del self.shelf[key]
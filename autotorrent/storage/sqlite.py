@@ -0,0 +1,172 @@
+from __future__ import absolute_import, unicode_literals
+
+import logging
+import sqlite3
+import threading
+
+from six.moves import cPickle as pickle
+
+from ._base import BaseStorage, synchronized, SINGLE_TABLES, TABLES
+
+logger = logging.getLogger(__name__)
+
+QUERY_BATCH_SIZE = 500 # max number of keys looked up in one query, sqlite limits the number of parameters
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS normal (key TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER, name TEXT)',
+    'CREATE INDEX IF NOT EXISTS normal_size ON normal (size)',
+    'CREATE INDEX IF NOT EXISTS normal_name ON normal (name)',
+
+    'CREATE TABLE IF NOT EXISTS unsplitable (key TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER, name TEXT)',
+    'CREATE INDEX IF NOT EXISTS unsplitable_size ON unsplitable (size)',
+    'CREATE INDEX IF NOT EXISTS unsplitable_name ON unsplitable (name)',
+
+    'CREATE TABLE IF NOT EXISTS exact (key TEXT NOT NULL, path TEXT NOT NULL, size INTEGER, name TEXT)',
+    'CREATE INDEX IF NOT EXISTS exact_key ON exact (key)',
+
+    'CREATE TABLE IF NOT EXISTS hash_name (key TEXT NOT NULL, path TEXT NOT NULL, size INTEGER, name TEXT)',
+    'CREATE INDEX IF NOT EXISTS hash_name_key ON hash_name (key)',
+    'CREATE INDEX IF NOT EXISTS hash_name_name ON hash_name (name)',
+
+    'CREATE TABLE IF NOT EXISTS hash_size (key INTEGER NOT NULL, path TEXT NOT NULL, size INTEGER, name TEXT)',
+    'CREATE INDEX IF NOT EXISTS hash_size_key ON hash_size (key)',
+
+    'CREATE TABLE IF NOT EXISTS directories (path TEXT PRIMARY KEY, record BLOB NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value BLOB NOT NULL)',
+]
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Storage using SQLite with a table per scan mode.
+
+    The database runs in WAL mode, so readers, e.g. -a runs, keep seeing
+    the previous content until a rebuild calls sync.
+    """
+    identifier = 'sqlite'
+    file_suffix = '.sqlite'
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+        self.connection.commit()
+
+    @synchronized
+    def truncate(self):
+        for table in TABLES + ('directories', 'meta'):
+            self.connection.execute('DELETE FROM %s' % table)
+
+    @synchronized
+    def sync(self):
+        self.connection.commit()
+
+    @synchronized
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def _insert_statement(self, table):
+        if table in SINGLE_TABLES:
+            statement = 'INSERT OR REPLACE INTO %s (key, path, size, name) VALUES (?, ?, ?, ?)'
+        else:
+            statement = 'INSERT INTO %s (key, path, size, name) VALUES (?, ?, ?, ?)'
+        return statement % table
+
+    @synchronized
+    def add(self, table, key, path, size=None, name=None):
+        self.connection.execute(self._insert_statement(table), (key, path, size, name))
+
+    @synchronized
+    def add_many(self, table, entries):
+        self.connection.executemany(self._insert_statement(table), entries)
+
+    @synchronized
+    def remove(self, table, key, path):
+        self.connection.execute('DELETE FROM %s WHERE key = ? AND path = ?' % table, (key, path))
+
+    @synchronized
+    def remove_many(self, table, entries):
+        self.connection.executemany('DELETE FROM %s WHERE key = ? AND path = ?' % table, entries)
+
+    @synchronized
+    def get(self, table, key):
+        cursor = self.connection.execute('SELECT path FROM %s WHERE key = ? ORDER BY rowid' % table, (key, ))
+        paths = [row[0] for row in cursor]
+        if table in SINGLE_TABLES:
+            return paths and paths[0] or None
+        return paths
+
+    @synchronized
+    def get_many(self, table, keys):
+        keys = list(set(keys))
+        single = table in SINGLE_TABLES
+        result = dict((key, None if single else []) for key in keys)
+        for i in range(0, len(keys), QUERY_BATCH_SIZE):
+            batch = keys[i:i+QUERY_BATCH_SIZE]
+            query = 'SELECT key, path FROM %s WHERE key IN (%s) ORDER BY rowid' % (table, ', '.join('?' * len(batch)))
+            for key, path in self.connection.execute(query, batch):
+                if not single:
+                    result[key].append(path)
+                elif result[key] is None:
+                    result[key] = path
+        return result
+
+    @synchronized
+    def keys(self, table):
+        return [row[0] for row in self.connection.execute('SELECT DISTINCT key FROM %s' % table)]
+
+    @synchronized
+    def get_sizes(self, min_size=None, max_size=None):
+        query, args = 'SELECT DISTINCT key FROM hash_size', []
+        if min_size is not None:
+            query += ' WHERE key >= ?'
+            args.append(min_size)
+
+        if max_size is not None:
+            query += min_size is None and ' WHERE' or ' AND'
+            query += ' key <= ?'
+            args.append(max_size)
+
+        return [row[0] for row in self.connection.execute(query + ' ORDER BY key', args)]
+
+    @synchronized
+    def get_meta(self, key, default=None):
+        row = self.connection.execute('SELECT value FROM meta WHERE key = ?', (key, )).fetchone()
+        if row is None:
+            return default
+        return pickle.loads(bytes(row[0]))
+
+    @synchronized
+    def set_meta(self, key, value):
+        self.connection.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                                (key, sqlite3.Binary(pickle.dumps(value, protocol=2))))
+
+    @synchronized
+    def get_directory(self, path):
+        row = self.connection.execute('SELECT record FROM directories WHERE path = ?', (path, )).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(bytes(row[0]))
+
+    @synchronized
+    def set_directory(self, path, record):
+        self.connection.execute('INSERT OR REPLACE INTO directories (path, record) VALUES (?, ?)',
+                                (path, sqlite3.Binary(pickle.dumps(record, protocol=2))))
+
+    @synchronized
+    def set_directories(self, records):
+        self.connection.executemany('INSERT OR REPLACE INTO directories (path, record) VALUES (?, ?)',
+                                    [(path, sqlite3.Binary(pickle.dumps(record, protocol=2))) for path, record in records])
+
+    @synchronized
+    def remove_directory(self, path):
+        self.connection.execute('DELETE FROM directories WHERE path = ?', (path, ))
+
+    @synchronized
+    def remove_directories(self, paths):
+        self.connection.executemany('DELETE FROM directories WHERE path = ?', [(path, ) for path in paths])
@@ -11,6 +11,7 @@ from unittest import TestCase
 from ..at import AutoTorrent, Status
 from ..bencode import bdecode, bencode
 from ..db import Database
+from ..storage import ShelveStorage
 
 def create_file(temp_folder, path, size):
     path = os.path.join(temp_folder, *path)
@@ -21,9 +22,16 @@ def create_file(temp_folder, path, size):
     with open(path, 'w') as f:
         f.write(u'x' * size)
 
+class DictStorage(ShelveStorage):
+    def __init__(self):
+        super(DictStorage, self).__init__(None)
+    
+    def open_shelf(self, flag='c'):
+        return {}
+
 class DummyDatabase(Database):
     def __init__(self):
-        self.db = {}
+        self.db = DictStorage()
         self.normal_mode = True
         self.unsplitable_mode = True
         self.exact_mode = True
@@ -41,7 +49,7 @@ class DummyDatabase(Database):
     def add_file(self, f, size):
         basename = os.path.basename(f)
         key = self.keyify(size, self.normalize_filename(basename))
-        self.db[key] = f
+        self.db.add('normal', key, f)
 
 class DummyAutoTorrent(AutoTorrent):
     def __init__(self, *args, **kwargs):
@@ -53,6 +61,8 @@ class DummyAutoTorrent(AutoTorrent):
         #return super(DummyAutoTorrent, self).print_status(*args, **kwargs)
 
 class DummyClient(object):
+    partial_resume = False
+
     def __init__(self):
         self.hashes = set()
     
@@ -63,6 +73,8 @@ class DummyClient(object):
         infohash = hashlib.sha1(bencode(torrent[b'info'])).hexdigest()
         self.hashes.add(infohash)
         self.last_destination_path = destination_path
+        self.last_files = files
+        self.last_fast_resume = fast_resume
         return True
 
 class TestAutoTorrent(TestCase):
@@ -626,6 +638,56 @@ class TestAutoTorrent(TestCase):
         
         return single_torrent, multi_torrent
     
+    def test_verify_files(self):
+        with open(os.path.join(self.src, 'hashalignment', 'file_b'), 'r+b') as f:
+            f.seek(10000)
+            f.write(b'x' * 64)
+        
+        self.actual_db.rebuild()
+        self.at.db = self.actual_db
+        with open(os.path.join(self.src, 'hashalignment_multifile.torrent'), 'rb') as f:
+            torrent = bdecode(f.read())
+        
+        self.assertEqual(self.at.parse_torrent(torrent)[:2], (42 * 1024, 0))
+        
+        self.at.verify_ratio = 1
+        found_size, missing_size, files = self.at.parse_torrent(torrent)
+        self.assertEqual((found_size, missing_size), (20480, 22528))
+        self.assertEqual([f['completed'] for f in files['files']], [True, False])
+        self.assertEqual(files['files'][1]['actual_path'], None)
+    
+    def test_verify_budget(self):
+        with open(os.path.join(self.src, 'hashalignment', 'file_b'), 'r+b') as f:
+            f.seek(10000)
+            f.write(b'x' * 64)
+        
+        self.actual_db.rebuild()
+        self.at.db = self.actual_db
+        with open(os.path.join(self.src, 'hashalignment_multifile.torrent'), 'rb') as f:
+            torrent = bdecode(f.read())
+        
+        piece_size = torrent[b'info'][b'piece length']
+        self.at.verify_ratio = 1
+        self.at.verify_budget = piece_size * 4 # the first and last piece of both files
+        self.assertEqual(self.at.parse_torrent(torrent)[:2], (42 * 1024, 0))
+        self.assertEqual(self.at.verified_bytes, piece_size * 4)
+        
+        self.assertEqual(self.at.parse_torrent(torrent)[:2], (42 * 1024, 0)) # used up, not verified
+        self.assertEqual(self.at.verified_bytes, piece_size * 4)
+        
+        self.at.verify_budget = 0
+        self.assertEqual(self.at.parse_torrent(torrent)[:2], (20480, 22528))
+    
+    def test_rank_hash_candidates(self):
+        path = os.path.join(self.src, 'hashalignment')
+        os.link(os.path.join(path, 'file_a'), os.path.join(path, 'file_a_link'))
+        shutil.copy(os.path.join(path, 'file_a'), os.path.join(path, 'file_c'))
+        
+        candidates = [os.path.join(path, name) for name in ['file_b', 'file_a', 'file_a_link', 'missing', 'file_c', 'file_a']]
+        f = {'path': ['file_c'], 'length': 20480}
+        self.assertEqual(self.at.rank_hash_candidates(f, candidates),
+                         [os.path.join(path, name) for name in ['file_c', 'file_a', 'file_b']])
+    
     def test_align_singlefile(self):
         src = os.path.join(self.src, 'hashalignment', 'file_a')
         dst = os.path.join(self.src, 'hashalignment', 'randomname')
@@ -892,6 +954,34 @@ class TestAutoTorrent(TestCase):
         
         self.assertTrue(self._check_at_log(Status.OK))
     
+    def test_handle_torrentfile_hashcheck_partial_resume(self):
+        src = os.path.join(self.src, 'hashalignment', 'file_b')
+        with open(src, 'rb') as f:
+            data = f.read()
+        
+        with open(src, 'wb') as f:
+            f.write(data[:10028])
+            f.write(data[11029:])
+        
+        self.client.partial_resume = True
+        self.actual_db.hash_slow_mode = True
+        single_torrent, multi_torrent = self._align_setup()
+        
+        result = self.at.handle_torrentfile(os.path.join(self.src, 'hashalignment_singlefile.torrent'))
+        self.assertEqual(result, Status.OK)
+        self.assertTrue(self.client.last_fast_resume)
+        
+        piece_size = single_torrent[b'info'][b'piece length']
+        pieces = single_torrent[b'info'][b'pieces']
+        with open(os.path.join(self.dst, 'hashalignment_singlefile', 'file_b'), 'rb') as f:
+            rewritten = f.read()
+        
+        matching = [i for i in range(len(pieces) // 20)
+                    if hashlib.sha1(rewritten[i*piece_size:(i+1)*piece_size]).digest() == pieces[i*20:(i+1)*20]]
+        f = self.client.last_files[0]
+        self.assertEqual(f['verified_pieces'], matching)
+        self.assertTrue(0 < len(matching) < len(pieces) // 20)
+    
     def test_handle_torrentfile_hashcheck_realign_single_file_too_different(self):
         src = os.path.join(self.src, 'hashalignment', 'file_b')
         dst = os.path.join(self.src, 'hashalignment', 'othername_WHAT')
@@ -1,13 +1,45 @@
+import hashlib
 import os
 
-from io import open
+from io import BytesIO, open
 from unittest import TestCase
 
-from ..bencode import bdecode, bencode
+from ..bencode import Bencached, BTFailure, bdecode, bdecode_torrent, bencode, bencode_to
 
 class TestBEncode(TestCase):
     def test_reencode(self):
         with open(os.path.join(os.path.dirname(__file__), 'testfiles', 'test.torrent'), 'rb') as f:
             data = f.read()
         
-        self.assertEqual(data, bencode(bdecode(data)))
\ No newline at end of file
+        self.assertEqual(data, bencode(bdecode(data)))
+    
+    def test_decode(self):
+        self.assertEqual(bdecode(b'd1:ali1ei-20e0:lee1:b3:xyz1:cd1:di0eee'),
+                         {b'a': [1, -20, b'', []], b'b': b'xyz', b'c': {b'd': 0}})
+        
+        for invalid in [b'', b'i01e', b'i-0e', b'03:abc', b'5:abc', b'l', b'i1ei2e', b'd1:ae', b'di1ei2ee', b'x', b'e', b'i1xe']:
+            self.assertRaises(BTFailure, bdecode, invalid)
+    
+    def test_decode_deep(self):
+        depth = 100000
+        value = bdecode(b'l' * depth + b'e' * depth)
+        for _ in range(depth - 1):
+            value = value[0]
+        self.assertEqual(value, [])
+    
+    def test_decode_torrent(self):
+        with open(os.path.join(os.path.dirname(__file__), 'testfiles', 'test.torrent'), 'rb') as f:
+            data = f.read()
+        
+        torrent, info = bdecode_torrent(data)
+        self.assertEqual(info.tobytes(), bencode(torrent[b'info']))
+        self.assertTrue(isinstance(torrent[b'info'][b'pieces'], memoryview))
+        self.assertEqual(hashlib.sha1(info).hexdigest(), '2ce6b00e106f26a7c56dbd2c52290e4b6dea10c0')
+        self.assertRaises(BTFailure, bdecode_torrent, b'de')
+    
+    def test_bencode_to(self):
+        value = {b'a': [1, b'xyz', {b'b': Bencached(b'i5e')}], b'c': memoryview(b'abc')}
+        f = BytesIO()
+        bencode_to(value, f)
+        self.assertEqual(f.getvalue(), b'd1:ali1e3:xyzd1:bi5eee1:c3:abce')
+        self.assertEqual(f.getvalue(), bencode(value))
@@ -4,12 +4,15 @@ import logging
 import os
 import shutil
 import tempfile
+import threading
 
 from io import open
 from logging.handlers import BufferingHandler
 from unittest import TestCase
 
 from ..db import Database
+from ..index import KeySizes, SizeIndex
+from ..storage import WriteBuffer
 
 def create_file(temp_folder, path, size):
     path = os.path.join(temp_folder, *path)
@@ -31,6 +34,9 @@ class TestHandler(BufferingHandler):
         self.buffer.append(record.msg)
 
 class TestDatabase(TestCase):
+    db_backend = 'shelve'
+    lookup_index = False
+    
     def setUp(self):
         self._temp_path = tempfile.mkdtemp()
         self._fs = [
@@ -57,7 +63,7 @@ class TestDatabase(TestCase):
         self.db = Database(os.path.join(self._temp_path, 'autotorrent.db'), [os.path.join(self._temp_path, '1'),
                                                                              os.path.join(self._temp_path, '2'),
                                                                              os.path.join(self._temp_path, '3')], [],
-                           True, True, True, False, False, False)
+                           True, True, True, False, False, False, self.db_backend, lookup_index=self.lookup_index)
         self.db.rebuild()
     
     def tearDown(self):
@@ -68,6 +74,40 @@ class TestDatabase(TestCase):
         key = 'test \xef\xbc\x9a'
         self.db.keyify(0, key)
     
+    def test_keyify_cached(self):
+        key = self.db.keyify(10, 'a')
+        self.db._key_cache[(10, 'a')] = 'cached'
+        self.assertEqual(self.db.keyify(10, 'a'), 'cached')
+
+        self.db.set_key_format('sha256')
+        self.assertEqual(self.db.keyify(10, 'a'), key)
+
+    def test_plain_key_format(self):
+        self.db.db_key_format = 'plain'
+        self.db.rebuild(incremental=True)
+
+        self.assertEqual(self.db.key_format, 'plain')
+        self.assertEqual(self.db.keyify(10, 'a'), 'k:10|a')
+        self.assertEqual(self.db.find_file_path('a', 10), os.path.join(self._temp_path, '1', 'a'))
+        self.test_unsplitable_release()
+        self.test_exact_release()
+
+        reader = Database(self.db.db_file, [], [], True, True, True, False, False, False, self.db_backend)
+        self.assertEqual(reader.key_format, 'plain')
+        reader.db.close()
+
+    def test_plain_key_format_prefixed_names(self):
+        create_file(self._temp_path, ['2', 's:5'], 5)
+        create_file(self._temp_path, ['2', 'd:x'], 6)
+        self.db.db_key_format = 'plain'
+        self.db.hash_name_mode = self.db.hash_size_mode = True
+        self.db.rebuild()
+        
+        self.assertEqual(self.db.db.get_sizes(max_size=6), [5, 6])
+        self.assertEqual(self.db.find_hash_name('s:5'), [os.path.join(self._temp_path, '2', 's:5')])
+        self.assertEqual(self.db.find_hash_name('d:x'), [os.path.join(self._temp_path, '2', 'd:x')])
+        self.assertTrue(self.db.get_hash_name_key('d:x') in self.db.db.keys('hash_name'))
+    
     def test_initial_build(self):
         for p, size in self._fs:
             result = self.db.find_file_path(p[-1], size)
@@ -104,6 +144,233 @@ class TestDatabase(TestCase):
         
         self.test_initial_build()
     
+    def test_rebuild_incremental(self):
+        fs = [
+            (['2', 'f'], 15),
+            (['1', 'f', 'g', 'h'], 17),
+        ]
+        for p, size in fs:
+            create_file(self._temp_path, p, size)
+        
+        os.remove(os.path.join(self._temp_path, '2', 'e'))
+        shutil.rmtree(os.path.join(self._temp_path, '3', 'Some-Release'))
+        
+        self._fs.pop()
+        self._fs += fs
+        
+        self.db.rebuild(incremental=True)
+        
+        self.test_initial_build()
+        self.assertEqual(self.db.find_file_path('e', 15), None)
+        self.assertEqual(self.db.find_unsplitable_file_path('Some-Release', ['some-rls.r01'], 12), None)
+        self.assertEqual(self.db.find_exact_file_path('d', 'Some-Release'), None)
+        self.test_unsplitable_release_multicd()
+    
+    def test_rebuild_incremental_batched_removes(self):
+        def remove(*args, **kwargs):
+            raise AssertionError('Entry removed outside of a batch')
+        
+        self.db.db.remove, self.db.db.remove_directory = remove, remove
+        self.test_rebuild_incremental()
+    
+    def test_write_buffer_order(self):
+        path_a, path_b = os.path.join(self._temp_path, 'a'), os.path.join(self._temp_path, 'b')
+        buffer = WriteBuffer(self.db.db)
+        buffer.add('normal', 'k', path_a)
+        buffer.add('exact', 'e', path_a)
+        buffer.set_directory(path_a, {'entries': [], 'dirs': []})
+        buffer.flush()
+        
+        buffer.remove('normal', 'k', path_a)
+        buffer.remove('exact', 'e', path_a)
+        buffer.remove_directory(path_a)
+        self.assertEqual(buffer.get('normal', 'k'), None)
+        self.assertEqual(buffer.get_many('normal', ['k']), {'k': None})
+        self.assertEqual(buffer.get_directory(path_a), None)
+        
+        buffer.add('normal', 'k', path_b)
+        buffer.add('exact', 'e', path_b)
+        buffer.add('exact', 'e', path_a)
+        buffer.add('unsplitable', 'u', path_b)
+        buffer.remove('unsplitable', 'u', path_b)
+        buffer.set_directory(path_a, {'entries': [], 'dirs': ['b']})
+        self.assertEqual(buffer.get('normal', 'k'), path_b)
+        self.assertEqual(buffer.get('unsplitable', 'u'), None)
+        buffer.flush()
+        
+        self.assertEqual(self.db.db.get('normal', 'k'), path_b)
+        self.assertEqual(self.db.db.get('unsplitable', 'u'), None)
+        self.assertEqual(sorted(self.db.db.get('exact', 'e')), [path_a, path_b])
+        self.assertEqual(self.db.db.get_directory(path_a), {'entries': [], 'dirs': ['b']})
+    
+    def test_rebuild_incremental_shadowed_duplicate(self):
+        create_file(self._temp_path, ['2', 'a'], 10)
+        self.db.rebuild()
+        self.assertEqual(self.db.find_file_path('a', 10), os.path.join(self._temp_path, '2', 'a'))
+        
+        os.remove(os.path.join(self._temp_path, '2', 'a'))
+        self.db.rebuild(incremental=True)
+        self.assertEqual(self.db.find_file_path('a', 10), os.path.join(self._temp_path, '1', 'a'))
+        
+        create_file(self._temp_path, ['2', 'x', 'a'], 10)
+        self.db.rebuild(incremental=True)
+        self.assertEqual(self.db.find_file_path('a', 10), os.path.join(self._temp_path, '2', 'x', 'a'))
+        
+        shutil.rmtree(os.path.join(self._temp_path, '2', 'x'))
+        self.db.rebuild(incremental=True)
+        self.assertEqual(self.db.find_file_path('a', 10), os.path.join(self._temp_path, '1', 'a'))
+    
+    def test_rebuild_incremental_unchanged(self):
+        listed = []
+        list_directory = self.db.list_directory
+        def counting_list_directory(path, *args):
+            listed.append(path)
+            return list_directory(path, *args)
+        self.db.list_directory = counting_list_directory
+        
+        create_file(self._temp_path, ['2', 'f'], 15)
+        self._fs.append((['2', 'f'], 15))
+        
+        self.db.rebuild(incremental=True)
+        
+        self.assertEqual(listed, [os.path.join(self._temp_path, '2')])
+        self.test_initial_build()
+    
+    def test_rebuild_incremental_new_unsplitable(self):
+        fs = [
+            (['1', 'New-Release', 'new-rls.rar'], 10),
+            (['1', 'New-Release', 'new-rls.sfv'], 11),
+        ]
+        create_file(self._temp_path, ['1', 'New-Release', 'Sample', 'new-rls.mkv'], 12)
+        self.db.rebuild(incremental=True)
+        self.assertEqual(self.db.find_file_path('new-rls.mkv', 12),
+                         os.path.join(self._temp_path, '1', 'New-Release', 'Sample', 'new-rls.mkv'))
+        
+        for p, size in fs:
+            create_file(self._temp_path, p, size)
+        self.db.rebuild(incremental=True)
+        
+        self.assertEqual(self.db.find_file_path('new-rls.mkv', 12), None)
+        self.assertEqual(self.db.find_unsplitable_file_path('New-Release', ['sample', 'new-rls.mkv'], 12),
+                         os.path.join(self._temp_path, '1', 'New-Release', 'Sample', 'new-rls.mkv'))
+        self.assertEqual(self.db.find_unsplitable_file_path('New-Release', ['new-rls.rar'], 10),
+                         os.path.join(self._temp_path, '1', 'New-Release', 'new-rls.rar'))
+    
+    def test_rebuild_incremental_changed_settings(self):
+        self.db.ignore_files = ['a*']
+        self.db.rebuild(incremental=True)
+        
+        items = [self._fs.pop(0), self._fs.pop(1)]
+        for p, size in items:
+            self.assertEqual(self.db.find_file_path(p[-1], size), None)
+        
+        self.test_initial_build()
+    
+    def test_rebuild_reuses_listing_stats(self):
+        def fail(*args, **kwargs):
+            raise AssertionError('Disk accessed outside of the directory listing')
+        
+        access, getsize = os.access, os.path.getsize
+        os.access, os.path.getsize = fail, fail
+        try:
+            self.db.rebuild()
+        finally:
+            os.access, os.path.getsize = access, getsize
+        
+        self.test_initial_build()
+        self.test_unsplitable_release()
+    
+    def test_rebuild_batched_writes(self):
+        batches = []
+        def add(*args, **kwargs):
+            raise AssertionError('Entry written outside of a batch')
+
+        def add_many(table, entries):
+            batches.append((table, len(entries)))
+            return storage_add_many(table, entries)
+
+        storage_add_many = self.db.db.add_many
+        self.db.db.add, self.db.db.add_many = add, add_many
+        self.db.write_batch_size = 3
+        self.db.hash_size_mode = True
+        self.db.rebuild()
+
+        self.assertTrue(len(batches) > 1)
+        self.assertTrue(max(count for _, count in batches) <= 3)
+        self.assertEqual(self.db.find_file_path('a', 10), os.path.join(self._temp_path, '1', 'a'))
+        self.assertEqual(sorted(self.db.find_hash_size(12)), [os.path.join(self._temp_path, '1', 'f', 'a'),
+                                                              os.path.join(self._temp_path, '2', 'd')])
+        self.test_unsplitable_release()
+        self.test_exact_release()
+
+    def test_rebuild_duplicate_in_batch(self):
+        h = TestHandler()
+        l = logging.getLogger('autotorrent.db')
+        l.addHandler(h)
+
+        create_file(self._temp_path, ['2', 'a'], 10)
+        self.db.rebuild()
+
+        duplicates = [x for x in h.buffer if x.startswith('Duplicate key')]
+        self.assertEqual(len(duplicates), 1)
+
+        l.removeHandler(h)
+        h.close()
+
+    def test_rebuild_stats(self):
+        self.db.scan_workers = 1
+        stats = self.db.rebuild()
+        
+        self.assertEqual([x['path'] for x in stats], [os.path.join(self._temp_path, p) for p in ['1', '2', '3']])
+        self.assertEqual([(x['directories'], x['files'], x['bytes']) for x in stats[:2]], [(2, 4, 57), (1, 2, 27)])
+        self.test_initial_build()
+        self.test_exact_release()
+    
+    def _hold_scan(self, held_path, released):
+        """
+        Makes the scan of the directories in held_path wait until released is set.
+        """
+        scan_directory = self.db.__class__.scan_directory.__get__(self.db)
+        def held_scan_directory(root, *args, **kwargs):
+            if root.startswith(held_path):
+                self.assertTrue(released.wait(10))
+            return scan_directory(root, *args, **kwargs)
+        self.db.scan_directory = held_scan_directory
+    
+    def _release_on_insert(self, path, released):
+        """
+        Sets released when path is inserted into the database.
+        """
+        insert_into_database = self.db.__class__.insert_into_database.__get__(self.db)
+        def releasing_insert_into_database(root, f, *args, **kwargs):
+            result = insert_into_database(root, f, *args, **kwargs)
+            if os.path.join(root, f) == path:
+                released.set()
+            return result
+        self.db.insert_into_database = releasing_insert_into_database
+    
+    def test_rebuild_paths_interleaved(self):
+        released = threading.Event()
+        self._hold_scan(os.path.join(self._temp_path, '1'), released)
+        
+        roots = []
+        for result in self.db.scan_paths(self.db.paths): # the other paths come while the first is held
+            roots.append(result[0])
+            if os.path.join(self._temp_path, '2') in roots and os.path.join(self._temp_path, '3') in roots:
+                released.set()
+        
+        self.assertTrue(roots.index(os.path.join(self._temp_path, '1')) > roots.index(os.path.join(self._temp_path, '2')))
+        self.assertTrue(roots.index(os.path.join(self._temp_path, '1')) > roots.index(os.path.join(self._temp_path, '3')))
+    
+    def test_rebuild_later_path_wins(self):
+        create_file(self._temp_path, ['2', 'a'], 10)
+        for held, first in [('2', '1'), ('1', '2')]: # the file in the earlier path is inserted first, then last
+            released = threading.Event()
+            self._hold_scan(os.path.join(self._temp_path, held), released)
+            self._release_on_insert(os.path.join(self._temp_path, first, 'a'), released)
+            self.db.rebuild()
+            self.assertEqual(self.db.find_file_path('a', 10), os.path.join(self._temp_path, '2', 'a'))
+    
     def test_ignore_file(self):
         self.db.ignore_files = ['a*']
         self.db.rebuild()
@@ -167,6 +434,24 @@ class TestDatabase(TestCase):
         self.assertEqual(self.db.find_unsplitable_file_path('Some-CD-Release', ['Sample', 'some-rls.mkv'], 12),
                          os.path.join(self._temp_path, '3', 'Some-CD-Release', 'Sample', 'some-rls.mkv'))
     
+    def test_unsplitable_release_found_in_subfolder(self):
+        fs = [
+            (['1', 'Rls', 'Extras', 'rls.nfo'], 13),
+            (['1', 'Rls', 'CD1', 'rls.rar'], 14),
+            (['1', 'Rls', 'CD1', 'rls.sfv'], 14),
+        ]
+        for p, size in fs:
+            create_file(self._temp_path, p, size)
+        self.db.rebuild()
+        
+        self.assertEqual(self.db.find_file_path('rls.nfo', 13), None)
+        self.assertEqual(self.db.find_unsplitable_file_path('Rls', ['extras', 'rls.nfo'], 13),
+                         os.path.join(self._temp_path, '1', 'Rls', 'Extras', 'rls.nfo'))
+        self.assertEqual(self.db.find_unsplitable_file_path('Rls', ['cd1', 'rls.rar'], 14),
+                         os.path.join(self._temp_path, '1', 'Rls', 'CD1', 'rls.rar'))
+        self.assertEqual(self.db.find_exact_file_path('d', 'Rls'), [os.path.join(self._temp_path, '1', 'Rls')])
+        self.assertEqual(self.db.find_exact_file_path('d', 'Extras'), None)
+    
     def test_exact_release(self):
         self.assertEqual(self.db.find_exact_file_path('d', 'Some-Release'),
                          [os.path.join(self._temp_path, '3', 'Some-Release')])
@@ -180,6 +465,25 @@ class TestDatabase(TestCase):
                          [os.path.join(self._temp_path, '1', 'a'),
                           os.path.join(self._temp_path, '1', 'f', 'a')])
     
+    def test_find_many(self):
+        requests = [
+            ('file_path', ('a', 10)),
+            ('file_path', ('b', 20)),
+            ('file_path', ('a', 11)),
+            ('file_path', ('a', 10)),
+            ('unsplitable_file_path', ('Some-Release', ['some-rls.r01'], 12)),
+            ('unsplitable_file_path', ('Some-Release', ['missing.r01'], 12)),
+            ('exact_file_path', ('f', 'a')),
+            ('exact_file_path', ('f', 'some-rls.mkv')),
+        ]
+        expected = [getattr(self.db, 'find_%s' % kind)(*args) for kind, args in requests]
+        self.assertEqual(expected[0], os.path.join(self._temp_path, '1', 'a'))
+        self.assertEqual(self.db.find_many(requests), expected)
+        self.assertEqual(self.db.find_many([]), [])
+        
+        requests = [('file_path', ('a', size)) for size in range(1200)] # more than one query of keys
+        self.assertEqual(self.db.find_many(requests), [self.db.find_file_path('a', size) for size in range(1200)])
+    
     def test_exact_bluray_release(self):
         self.assertEqual(self.db.find_exact_file_path('d', 'My-Bluray'), [os.path.join(self._temp_path, '3', 'My-Bluray')])
     
@@ -220,6 +524,66 @@ class TestDatabase(TestCase):
                          sorted([os.path.join(self._temp_path, '3', 'Some-Release', 'Sample', 'some-rls.mkv'),
                           os.path.join(self._temp_path, '3', 'Some-CD-Release', 'Sample', 'some-rls.mkv')]))
 
+    def test_hash_size_index(self):
+        self.db.hash_slow_mode = True
+        self.db.rebuild()
+
+        def fail(*args, **kwargs):
+            raise AssertionError('Sizes read from the database')
+        get_sizes, self.db.db.get_sizes = self.db.db.get_sizes, fail
+        self.db.build_hash_size_table()
+
+        self.assertTrue(isinstance(self.db.hash_size_table, SizeIndex))
+        self.assertEqual(list(self.db.hash_size_table)[:4], [10, 12, 15, 20])
+        self.assertEqual(self.db.find_hash_varying_size(11),
+                         [os.path.join(self._temp_path, '1', 'a'),
+                          os.path.join(self._temp_path, '1', 'f', 'a'),
+                          os.path.join(self._temp_path, '2', 'd')])
+
+        self.db.clear_hash_size_table()
+        self.db.hash_size_table = [10, 12, 15, 20]
+        self.db.hash_mode_size_varying = 25.0
+        self.assertEqual(self.db.find_hash_varying_size(16),
+                         [os.path.join(self._temp_path, '1', 'f', 'c'),
+                          os.path.join(self._temp_path, '2', 'e'),
+                          os.path.join(self._temp_path, '1', 'f', 'a'),
+                          os.path.join(self._temp_path, '2', 'd'),
+                          os.path.join(self._temp_path, '1', 'b')])
+
+        self.db.db.get_sizes = get_sizes
+        self.db.db.set_meta('hash_sizes_token', 'other database')
+        self.db.clear_hash_size_table()
+        self.db.build_hash_size_table()
+        self.assertFalse(isinstance(self.db.hash_size_table, SizeIndex))
+        self.assertEqual(list(self.db.hash_size_table)[:4], [10, 12, 15, 20])
+
+    def test_size_index_every_rebuild(self):
+        self.db.hash_slow_mode = True
+        self.db.rebuild()
+        token = self.db.db.get_meta('hash_sizes_token')
+        
+        self.db.hash_slow_mode = False
+        self.db.rebuild()
+        self.assertNotEqual(self.db.db.get_meta('hash_sizes_token'), token)
+        self.assertEqual(SizeIndex.open(self.db.get_size_index_path(), token), None)
+        
+        index = SizeIndex.open(self.db.get_size_index_path(), self.db.db.get_meta('hash_sizes_token'))
+        self.assertEqual(len(index), 0)
+        index.close()
+
+    def test_size_index_slicing(self):
+        path = os.path.join(self._temp_path, 'sizes')
+        SizeIndex.write(path, 'a' * 32, [1, 5, 2 ** 40])
+        index = SizeIndex.open(path, 'a' * 32)
+
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index[-1], 2 ** 40)
+        self.assertEqual(index[1:], [5, 2 ** 40])
+        self.assertEqual(index[2:1], [])
+        self.assertRaises(IndexError, lambda: index[3])
+        self.assertEqual(SizeIndex.open(path, 'b' * 32), None)
+        index.close()
+
     def test_inaccessible_file(self):
         h = TestHandler()
         l = logging.getLogger('autotorrent.db')
@@ -232,4 +596,86 @@ class TestDatabase(TestCase):
         self.assertTrue("Path %r is not accessible, skipping" % inaccessible_path in h.buffer)
         
         l.removeHandler(h)
-        h.close()
\ No newline at end of file
+        h.close()
+    
+    def test_readable_through_acl(self):
+        acl_path = os.path.join(self._temp_path, '1', 'a')
+        os.chmod(acl_path, 0000)
+        
+        access = os.access
+        os.access = lambda path, mode: os.path.abspath(path) == acl_path or access(path, mode) # as if an ACL allowed it
+        try:
+            self.db.rebuild()
+        finally:
+            os.access = access
+        
+        self.test_initial_build()
+
+class TestDatabaseSQLite(TestDatabase):
+    db_backend = 'sqlite'
+    
+    def test_read_while_rebuilding(self):
+        reader = Database(self.db.db_file, [], [], True, True, True, False, False, False, self.db_backend)
+        
+        self.db.truncate()
+        self.assertEqual(self.db.find_file_path('a', 10), None)
+        self.assertEqual(reader.find_file_path('a', 10), os.path.join(self._temp_path, '1', 'a'))
+        
+        self.db.db.sync()
+        self.assertEqual(reader.find_file_path('a', 10), None)
+        reader.db.close()
+    
+    def test_size_range(self):
+        self.db.hash_size_mode = True
+        self.db.rebuild()
+        
+        self.assertEqual(self.db.db.get_sizes(11, 15), [12, 15])
+        self.assertEqual(self.db.db.get_sizes(max_size=10), [10])
+    
+    def test_switch_from_shelve(self):
+        self.db.db.close()
+        os.remove(self.db.db_file + '.sqlite')
+        
+        shelve_db = Database(self.db.db_file, self.db.paths, [], True, True, True, False, False, False, 'shelve')
+        shelve_db.rebuild()
+        shelve_db.db.close()
+        
+        self.db = Database(self.db.db_file, self.db.paths, [], True, True, True, False, False, False, self.db_backend)
+        self.assertEqual(self.db.find_file_path('a', 10), None)
+        self.db.rebuild()
+        self.assertEqual(self.db.find_file_path('a', 10), os.path.join(self._temp_path, '1', 'a'))
+
+class TestDatabaseLookupIndex(TestDatabase):
+    lookup_index = True
+    
+    def test_lookup_without_storage(self):
+        reader = Database(self.db.db_file, [], [], True, True, True, False, False, False, self.db_backend)
+        
+        self.assertEqual(reader.find_file_path('a', 10), os.path.join(self._temp_path, '1', 'a'))
+        self.assertEqual(reader.find_unsplitable_file_path('Some-Release', ['some-rls.r01'], 12),
+                         os.path.join(self._temp_path, '3', 'Some-Release', 'some-rls.r01'))
+        self.assertEqual(reader.find_exact_file_path('f', 'a'),
+                         [os.path.join(self._temp_path, '1', 'a'),
+                          os.path.join(self._temp_path, '1', 'f', 'a')])
+        self.assertEqual(reader.find_file_path('a', 11), None)
+        self.assertEqual(reader._db, None)
+    
+    def test_hash_size_index(self):
+        self.db.hash_slow_mode = True
+        self.db.rebuild()
+        self.db.build_hash_size_table()
+        
+        self.assertTrue(isinstance(self.db.hash_size_table, KeySizes))
+        self.assertEqual(list(self.db.hash_size_table)[:4], [10, 12, 15, 20])
+        self.assertEqual(self.db.find_hash_varying_size(11),
+                         [os.path.join(self._temp_path, '1', 'a'),
+                          os.path.join(self._temp_path, '1', 'f', 'a'),
+                          os.path.join(self._temp_path, '2', 'd')])
+    
+    def test_lookup_index_removed(self):
+        self.db.lookup_index = False
+        self.db.rebuild()
+        
+        self.assertEqual(self.db.index, None)
+        self.assertFalse(os.path.exists(self.db.get_lookup_index_path()))
+        self.test_initial_build()
@@ -0,0 +1,75 @@
+import os
+import shutil
+import tempfile
+
+from unittest import TestCase
+
+from .. import rewrite
+from ..rewrite import FileCopier, rewrite_file
+
+
+class TestRewriteFile(TestCase):
+    def setUp(self):
+        self._temp_path = tempfile.mkdtemp()
+        self.data = os.urandom(3 * 4096 + 100)
+        self.source = os.path.join(self._temp_path, 'source')
+        self.destination = os.path.join(self._temp_path, 'destination')
+        with open(self.source, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_path)
+
+    def read_destination(self):
+        with open(self.destination, 'rb') as f:
+            return f.read()
+
+    def test_remove(self):
+        for point, diff in [(0, 10), (100, 4096), (4096, 4096), (len(self.data) - 10, 10)]:
+            rewrite_file(self.source, self.destination, 'remove', point, diff)
+            self.assertEqual(self.read_destination(), self.data[:point] + self.data[point+diff:])
+
+    def test_add(self):
+        for point, diff in [(0, 10), (100, 4096), (4096, 4096), (len(self.data), 10)]:
+            rewrite_file(self.source, self.destination, 'add', point, diff)
+            self.assertEqual(self.read_destination(), self.data[:point] + b'\x00' * diff + self.data[point:])
+
+    def test_add_sparse(self):
+        copier = rewrite_file(self.source, self.destination, 'add', 4096, 8192)
+        self.assertEqual(copier.methods['hole'], 8192)
+        self.assertEqual(self.read_destination(), self.data[:4096] + b'\x00' * 8192 + self.data[4096:])
+
+        copier = rewrite_file(self.source, self.destination, 'add', len(self.data), 8192)
+        self.assertEqual(copier.methods['hole'], 8192)
+        self.assertEqual(self.read_destination(), self.data + b'\x00' * 8192)
+
+    def test_add_not_sparse(self):
+        copier = rewrite_file(self.source, self.destination, 'add', 4096, 8192, sparse=False)
+        self.assertEqual(copier.methods['zeros'], 8192)
+        self.assertNotIn('hole', copier.methods)
+        self.assertEqual(self.read_destination(), self.data[:4096] + b'\x00' * 8192 + self.data[4096:])
+
+    def test_point_after_end(self):
+        rewrite_file(self.source, self.destination, 'add', len(self.data) + 1, 10)
+        self.assertEqual(self.read_destination(), self.data)
+
+    def test_copy_methods(self):
+        for disabled in ['can_clone', 'can_copy_file_range', 'can_sendfile']:
+            with open(self.source, 'rb') as source_fp:
+                with open(self.destination, 'wb') as destination_fp:
+                    copier = FileCopier(source_fp.fileno(), destination_fp.fileno())
+                    setattr(copier, disabled, False)
+                    self.assertEqual(copier.copy(10, 0, 5000), 5000)
+                    self.assertEqual(copier.copy(5010, 5000, 10000), len(self.data) - 5010)
+            self.assertEqual(self.read_destination(), self.data[10:])
+
+    def test_read_fallback(self):
+        with open(self.source, 'rb') as source_fp:
+            with open(self.destination, 'wb') as destination_fp:
+                copier = FileCopier(source_fp.fileno(), destination_fp.fileno(), clone=False)
+                copier.can_copy_file_range = copier.can_sendfile = False
+                copier.copy(0, 0, len(self.data))
+                copier.write_zeros(len(self.data), rewrite.CHUNK_SIZE + 1)
+
+        self.assertEqual(dict(copier.methods), {'read': len(self.data), 'zeros': rewrite.CHUNK_SIZE + 1})
+        self.assertEqual(self.read_destination(), self.data + b'\x00' * (rewrite.CHUNK_SIZE + 1))
@@ -0,0 +1,49 @@
+import os
+
+from io import BytesIO
+
+from unittest import TestCase
+
+from ..bencode import bdecode, bencode
+from ..torrent import Torrent, TorrentFile, encode_torrent, get_info_hash
+
+class TestTorrent(TestCase):
+    def setUp(self):
+        self.path = os.path.join(os.path.dirname(__file__), 'testfiles', 'test.torrent')
+        with open(self.path, 'rb') as f:
+            self.data = f.read()
+    
+    def test_torrent(self):
+        torrent = Torrent.from_file(self.path)
+        self.assertEqual(torrent, bdecode(self.data))
+        self.assertEqual(torrent.info_hash, '2ce6b00e106f26a7c56dbd2c52290e4b6dea10c0')
+        self.assertEqual(get_info_hash(torrent), get_info_hash(bdecode(self.data)))
+        self.assertEqual(encode_torrent(torrent), self.data)
+    
+    def test_encode_changed(self):
+        torrent = Torrent(self.data)
+        torrent[b'libtorrent_resume'] = {b'bitfield': 5}
+        
+        expected = bdecode(self.data)
+        expected[b'libtorrent_resume'] = {b'bitfield': 5}
+        self.assertEqual(encode_torrent(torrent), bencode(expected))
+        
+        f = BytesIO()
+        encode_torrent(torrent, f)
+        self.assertEqual(f.getvalue(), bencode(expected))
+    
+    def test_torrent_file(self):
+        f = TorrentFile(3, ['a', 'b'], 10, completed=False)
+        self.assertEqual(f, {'path': ['a', 'b'], 'length': 10, 'completed': False})
+        self.assertEqual(f['length'], 10)
+        self.assertFalse('postprocessing' in f)
+        self.assertEqual(f.get('postprocessing'), None)
+        self.assertRaises(KeyError, lambda: f['actual_path'])
+        self.assertRaises(KeyError, lambda: f['index'])
+        
+        f['postprocessing'] = ('rewrite', 'add', 0)
+        self.assertTrue('postprocessing' in f)
+        self.assertEqual(f.postprocessing, ('rewrite', 'add', 0))
+        self.assertNotEqual(f, {'path': ['a', 'b'], 'length': 10, 'completed': False})
+        self.assertEqual(dict(f), {'path': ['a', 'b'], 'length': 10, 'completed': False, 'postprocessing': ('rewrite', 'add', 0)})
+        self.assertEqual(f.index, 3)
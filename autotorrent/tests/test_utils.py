@@ -1,6 +1,14 @@
+import hashlib
+import io
+import os
+import shutil
+import struct
+import tempfile
+
+from concurrent.futures import ThreadPoolExecutor
 from unittest import TestCase
 
-from ..utils import Pieces
+from ..utils import Pieces, PieceCache, get_buffer, get_root_of_unsplitable, is_unsplitable_subfolder
 
 class TestPieces(TestCase):
     def setUp(self):
@@ -14,4 +22,215 @@ class TestPieces(TestCase):
         
     
     def test_get_complete_pieces(self):
-        self.assertEqual(self.pieces.get_complete_pieces(1, 15), (3, 3, ['\00'*(20)]*2))
\ No newline at end of file
+        self.assertEqual(self.pieces.get_complete_pieces(1, 15), (3, 3, ['\00'*(20)]*2))
+
+class TestPiecesHashing(TestCase):
+    def setUp(self):
+        self._temp_path = tempfile.mkdtemp()
+        self.data = b''.join(struct.pack('>I', i) for i in range(40))
+        self.torrent = {
+            b'info': {
+                b'piece length': 4,
+                b'pieces': b''.join(hashlib.sha1(self.data[i:i+4]).digest() for i in range(0, len(self.data), 4)),
+            }
+        }
+        
+        self.files = {
+            'match': self.data,
+            'changed_end': self.data[:100] + b'x' * 60,
+            'garbage': b'x' * 160,
+        }
+        for name, data in self.files.items():
+            with open(os.path.join(self._temp_path, name), 'wb') as f:
+                f.write(data)
+    
+    def tearDown(self):
+        if self._temp_path.startswith('/tmp'):
+            shutil.rmtree(self._temp_path)
+    
+    def get_results(self, pieces):
+        paths = [os.path.join(self._temp_path, name) for name in ['garbage', 'changed_end', 'match']]
+        results = [(os.path.basename(p), r) for p, r in pieces.match_files(paths, 0, len(self.data))]
+        return results, pieces.find_piece_breakpoint(paths[1], 0, len(self.data))
+    
+    def test_match_files(self):
+        results, breakpoint = self.get_results(Pieces(self.torrent))
+        self.assertEqual([(name, bool(s), bool(e)) for name, (s, e) in results],
+                         [('garbage', False, False), ('changed_end', True, False), ('match', True, True)])
+        self.assertEqual(breakpoint, 96)
+    
+    def test_match_files_concurrently(self):
+        executor = ThreadPoolExecutor(max_workers=3)
+        try:
+            self.assertEqual(self.get_results(Pieces(self.torrent, executor, 5)),
+                             self.get_results(Pieces(self.torrent)))
+        finally:
+            executor.shutdown()
+
+    def test_bisect_piece_breakpoint(self):
+        path = os.path.join(self._temp_path, 'inserted')
+        with open(path, 'wb') as f:
+            f.write(self.data[:100] + b'zz' + self.data[100:])
+        
+        pieces = Pieces(self.torrent)
+        self.assertEqual(pieces.bisect_piece_breakpoint(path, 0, len(self.data)), 96)
+        self.assertEqual(pieces.scan_piece_breakpoint(path, 0, len(self.data)), 96)
+        
+        path = os.path.join(self._temp_path, 'changed_end') # not explained by the size difference
+        self.assertEqual(pieces.bisect_piece_breakpoint(path, 0, len(self.data)), None)
+        self.assertEqual(pieces.find_piece_breakpoint(path, 0, len(self.data)), 96)
+    
+    def test_bisect_piece_breakpoint_reads(self):
+        data = b''.join(struct.pack('>I', i) for i in range(1000))
+        torrent = {
+            b'info': {
+                b'piece length': 4,
+                b'pieces': b''.join(hashlib.sha1(data[i:i+4]).digest() for i in range(0, len(data), 4)),
+            }
+        }
+        path = os.path.join(self._temp_path, 'removed')
+        with open(path, 'wb') as f:
+            f.write(data[:3600] + data[3610:])
+        
+        reads = []
+        pieces = Pieces(torrent)
+        hash_piece = pieces.hash_piece
+        def counting_hash_piece(file_path, offset):
+            reads.append(offset)
+            return hash_piece(file_path, offset)
+        pieces.hash_piece = counting_hash_piece
+        
+        self.assertEqual(pieces.find_piece_breakpoint(path, 0, len(data)), 3596)
+        self.assertTrue(len(reads) < 30, len(reads))
+    
+    def test_precheck_files(self):
+        paths = [os.path.join(self._temp_path, name) for name in ['garbage', 'changed_end', 'match']]
+        self.assertEqual(Pieces(self.torrent).precheck_files(paths, 0, len(self.data)), paths[1:])
+        self.assertEqual(Pieces(self.torrent).precheck_files(paths, 0, 3), [])
+    
+    def test_precheck_files_near_match(self):
+        path = os.path.join(self._temp_path, 'grown_start')
+        with open(path, 'wb') as f:
+            f.write(b'xx' + self.data[:-4] + b'yyyy') # nothing matches from the start and the last piece changed
+        
+        pieces = Pieces(self.torrent)
+        self.assertEqual(pieces.match_file(path, 0, len(self.data)), (0, True))
+        garbage = os.path.join(self._temp_path, 'garbage')
+        self.assertEqual(pieces.precheck_files([garbage, path], 0, len(self.data)), [path])
+    
+    def test_verify_files(self):
+        middle = os.path.join(self._temp_path, 'changed_middle')
+        with open(middle, 'wb') as f:
+            f.write(self.data[:60] + b'x' * 4 + self.data[64:])
+        
+        paths = [os.path.join(self._temp_path, name) for name in ['match', 'changed_end', 'garbage']]
+        for ratio, failed in [(0, paths[1:]), (1, paths[1:] + [middle])]:
+            for path in paths + [middle]:
+                result = Pieces(self.torrent).verify_files([(path, len(self.data))], ratio)
+                self.assertEqual(result, [path] if path in failed else [])
+        
+        executor = ThreadPoolExecutor(max_workers=3)
+        try:
+            self.assertEqual(Pieces(self.torrent, executor, 6).verify_files([(middle, len(self.data))], 1), [middle])
+        finally:
+            executor.shutdown()
+    
+    def test_files_kept_open(self):
+        path = os.path.join(self._temp_path, 'match')
+        handles = []
+        def counting_open(*args, **kwargs):
+            handles.append(io_open(*args, **kwargs))
+            return handles[-1]
+        
+        io_open, io.open = io.open, counting_open
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            pieces = Pieces(self.torrent, executor, 4)
+            self.assertEqual(pieces.verify_files([(path, len(self.data))], 1), [])
+        finally:
+            io.open = io_open
+            executor.shutdown()
+        
+        self.assertEqual(pieces.pieces_verified, len(self.data) // 4)
+        self.assertEqual([f.name for f in handles], [path])
+        self.assertTrue(handles[0].closed)
+        self.assertEqual(pieces.open_files, None)
+    
+    def test_verify_files_limit(self):
+        middle = os.path.join(self._temp_path, 'changed_middle')
+        with open(middle, 'wb') as f:
+            f.write(self.data[:60] + b'x' * 4 + self.data[64:])
+        
+        pieces = Pieces(self.torrent)
+        self.assertEqual(pieces.verify_files([(middle, len(self.data))], 1, 2), []) # only the first and the last piece
+        self.assertEqual(pieces.pieces_verified, 2)
+        self.assertEqual(pieces.verify_files([(middle, len(self.data))], 1, 1000), [middle])
+        
+        paths = [(os.path.join(self._temp_path, 'match'), 40), (os.path.join(self._temp_path, 'garbage'), len(self.data) - 40)]
+        self.assertEqual(Pieces(self.torrent).verify_files(paths, 1, 2), [paths[1][0]]) # the first piece of every file first
+    
+    def test_get_piece_parts(self):
+        pieces = Pieces(self.torrent)
+        self.assertEqual(list(pieces.get_piece_parts([('a', 3), ('b', 1), ('c', 6), (None, 2), ('d', 1), ('e', 9)])), [
+            (0, [('a', 0, 3), ('b', 0, 1)]),
+            (1, [('c', 0, 4)]),
+            (3, [('d', 0, 1), ('e', 0, 3)]),
+            (4, [('e', 3, 4)]),
+            (5, [('e', 7, 2)]),
+        ])
+    
+    def test_verify_small_files(self):
+        paths = []
+        for i, size in enumerate([3, 1, 2, 7, 5, 102, 1, 39]): # no whole pieces in most of them
+            paths.append((os.path.join(self._temp_path, 'small%i' % i), size))
+            position = sum(size for _, size in paths[:-1])
+            with open(paths[-1][0], 'wb') as f:
+                f.write(self.data[position:position + size])
+        
+        pieces = Pieces(self.torrent)
+        self.assertEqual(pieces.verify_files(paths), [])
+        
+        with open(paths[2][0], 'wb') as f:
+            f.write(b'xx')
+        self.assertEqual(pieces.verify_files(paths), [paths[2][0], paths[3][0]]) # piece 1 spans both
+        self.assertEqual(pieces.verify_files(paths[:2] + [(None, 2)] + paths[3:]), [])
+    
+    def test_piece_cache(self):
+        cache = PieceCache(os.path.join(self._temp_path, 'pieces'))
+        pieces = Pieces(self.torrent, cache=cache)
+        path = os.path.join(self._temp_path, 'match')
+        st = os.stat(path)
+        self.assertEqual(pieces.hash_piece(path, 4), hashlib.sha1(self.data[4:8]).digest())
+        cache.sync()
+        
+        with open(path, 'r+b') as f: # same size and modification time, the cached hash is used
+            f.write(b'y' * 8)
+        os.utime(path, (st.st_atime, st.st_mtime))
+        
+        pieces = Pieces(self.torrent, cache=PieceCache(os.path.join(self._temp_path, 'pieces')))
+        self.assertEqual(pieces.hash_piece(path, 4), hashlib.sha1(self.data[4:8]).digest())
+        self.assertEqual(pieces.hash_piece(path, 0), hashlib.sha1(b'y' * 4).digest())
+        
+        os.utime(path, (st.st_atime, st.st_mtime + 10))
+        self.assertEqual(pieces.hash_piece(path, 4), hashlib.sha1(b'y' * 4).digest())
+    
+    def test_hash_piece_reuses_buffer(self):
+        pieces = Pieces(self.torrent)
+        path = os.path.join(self._temp_path, 'match')
+        
+        self.assertEqual(pieces.hash_piece(path, 4), hashlib.sha1(self.data[4:8]).digest())
+        self.assertEqual(get_buffer(4).tobytes(), self.data[4:8])
+        self.assertEqual(pieces.hash_piece(path, 158), hashlib.sha1(self.data[158:]).digest())
+
+class TestUnsplitable(TestCase):
+    def test_is_unsplitable_subfolder(self):
+        for name in ['CD1', 'Sample', 'Subs', 'VobSubs', 'BDMV', 'VIDEO_TS', 'Disc2', '']:
+            self.assertTrue(is_unsplitable_subfolder(name), name)
+        
+        for name in ['Some-Release', 'Extras', 'Movie-CD1']:
+            self.assertFalse(is_unsplitable_subfolder(name), name)
+    
+    def test_get_root_of_unsplitable(self):
+        self.assertEqual(get_root_of_unsplitable(['', 'mnt', 'Some-Release', 'CD1']), 'Some-Release')
+        self.assertEqual(get_root_of_unsplitable(['', 'mnt', 'My-Bluray', 'BDMV', 'BACKUP']), 'BACKUP')
+        self.assertEqual(get_root_of_unsplitable(['', 'mnt', 'My-DVD', 'VIDEO_TS', '']), 'My-DVD')
@@ -0,0 +1,151 @@
+import hashlib
+
+import six
+
+from .bencode import Bencached, bdecode_torrent, bencode, bencode_to
+
+__all__ = [
+    'Torrent',
+    'TorrentFile',
+    'get_info_hash',
+    'encode_torrent',
+]
+
+
+class Torrent(dict):
+    """
+    A decoded torrent that keeps the data it was decoded from, so the info dict
+    is never encoded again. The info dict must not be modified.
+    """
+    def __init__(self, data):
+        torrent, raw_info = bdecode_torrent(data)
+        super(Torrent, self).__init__(torrent)
+        self.data = data
+        self.raw_info = raw_info
+        self._info_hash = None
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, 'rb') as f:
+            return cls(f.read())
+
+    @property
+    def info_hash(self):
+        if self._info_hash is None:
+            self._info_hash = hashlib.sha1(self.raw_info).hexdigest()
+        return self._info_hash
+
+    def _with_raw_info(self):
+        torrent = dict(self)
+        torrent[b'info'] = Bencached(self.raw_info.tobytes() if six.PY2 else self.raw_info)
+        return torrent
+
+    def encode(self):
+        """
+        Encodes the torrent with the other keys as they are now and the original info dict.
+        """
+        return bencode(self._with_raw_info())
+
+    def write(self, f):
+        """
+        Encodes the torrent like encode and writes it to the file-like object f.
+        """
+        bencode_to(self._with_raw_info(), f)
+
+
+class TorrentFile(object):
+    """
+    A file of a torrent and where it was found, index is its position in the torrent
+    and hash_checked is set when it was found by hash checking.
+
+    The fields can be used as keys like in a dict, the fields not set are missing keys,
+    so the records can be used where a dict of the fields is expected and compared to one.
+    """
+    __slots__ = ['index', 'hash_checked', 'path', 'length', 'actual_path', 'completed', 'postprocessing', 'verified_pieces']
+    FIELDS = ('path', 'length', 'actual_path', 'completed', 'postprocessing', 'verified_pieces')
+
+    def __init__(self, index, path, length, **fields):
+        self.index = index
+        self.hash_checked = False
+        self.path = path
+        self.length = length
+        for key, value in fields.items():
+            self[key] = value
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        delattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.FIELDS and hasattr(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [key for key in self.FIELDS if hasattr(self, key)]
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, (TorrentFile, dict)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'TorrentFile(%i, %r)' % (self.index, dict(self.items()))
+
+
+def get_info_hash(torrent):
+    """
+    Returns the info hash of a torrent, the decoded torrent can be a Torrent or a dict.
+    """
+    if isinstance(torrent, Torrent):
+        return torrent.info_hash
+    return hashlib.sha1(bencode(torrent[b'info'])).hexdigest()
+
+
+def encode_torrent(torrent, f=None):
+    """
+    Encodes a torrent, the decoded torrent can be a Torrent or a dict.
+    The encoded torrent is returned, or written to the file-like object f if given.
+    """
+    if f is not None:
+        if isinstance(torrent, Torrent):
+            torrent.write(f)
+        else:
+            bencode_to(torrent, f)
+    elif isinstance(torrent, Torrent):
+        return torrent.encode()
+    else:
+        return bencode(torrent)
@@ -1,14 +1,30 @@
 from __future__ import division
 
 import hashlib
+import io
 import logging
 import os
 import re
+import threading
+
+from collections import deque, OrderedDict
+from concurrent.futures import wait
+from itertools import islice
+
+from six.moves import zip_longest
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
 
 __all__ = [
     'is_unsplitable',
     'get_root_of_unsplitable',
+    'is_unsplitable_subfolder',
     'Pieces',
+    'PieceCache',
+    'get_buffer',
 ]
 
 UNSPLITABLE_FILE_EXTENSIONS = [
@@ -17,8 +33,12 @@ UNSPLITABLE_FILE_EXTENSIONS = [
     set(['.vob', '.ifo']),
 ]
 
+OPEN_FILES_PER_THREAD = 8 # files kept open by every hashing thread during a run of pieces
+
 logger = logging.getLogger(__name__)
 
+_buffers = threading.local()
+
 def is_unsplitable(files):
     """
     Checks if a list of files can be considered unsplitable, e.g. VOB/IFO or scene release.
@@ -38,6 +58,21 @@ def is_unsplitable(files):
     
     return found_unsplitable_extensions or found_magic_file
 
+def is_unsplitable_subfolder(name):
+    """
+    Checks if a folder name is a subfolder of a release, e.g. cd1 or video_ts folders.
+    """
+    if not name:
+        return True
+    
+    if re.match(r'^(cd[1-9])|(samples?)|(proofs?)|((vob)?sub(title)?s?)$', name, re.IGNORECASE): # scene paths
+        return True
+    
+    if re.match(r'^(bdmv)|(disc\d*)|(video_ts)$', name, re.IGNORECASE): # bluray / dd
+        return True
+    
+    return False
+
 def get_root_of_unsplitable(path):
     """
     Scans a path for the actual scene release name, e.g. skipping cd1 folders.
@@ -46,28 +81,176 @@ def get_root_of_unsplitable(path):
     """
     path = path[::-1]
     for p in path:
-        if not p:
+        if is_unsplitable_subfolder(p):
             continue
         
-        if re.match(r'^(cd[1-9])|(samples?)|(proofs?)|((vob)?sub(title)?s?)$', p, re.IGNORECASE): # scene paths
-            continue
+        return p
+
+def get_buffer(size):
+    """
+    Returns a writable memoryview of size bytes. The memory is kept and reused
+    by the calling thread, so it must be done with the view before asking again.
+    """
+    buf = getattr(_buffers, 'buffer', None)
+    if buf is None or len(buf) < size:
+        buf = _buffers.buffer = bytearray(size)
+    return memoryview(buf)[:size]
+
+class OpenFiles(object):
+    """
+    Keeps the files read while hashing a run of pieces open. Every thread
+    has its own handles, as they read from their own offsets.
+    """
+    def __init__(self, limit=OPEN_FILES_PER_THREAD):
+        self.limit = limit
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.handles = set()
+    
+    def open(self, file_path):
+        """
+        Returns the handle of file_path for the calling thread, opening it if needed.
+        """
+        files = getattr(self.local, 'files', None)
+        if files is None:
+            files = self.local.files = OrderedDict()
         
-        if re.match(r'^(bdmv)|(disc\d*)|(video_ts)$', p, re.IGNORECASE): # bluray / dd
-            continue
+        f = files.pop(file_path, None)
+        if f is None:
+            if len(files) >= self.limit:
+                _, f = files.popitem(last=False)
+                self._close(f)
+            f = io.open(file_path, 'rb', buffering=0)
+            with self.lock:
+                self.handles.add(f)
+        files[file_path] = f # the most recently used last
+        return f
+    
+    def _close(self, f):
+        with self.lock:
+            self.handles.discard(f)
+        f.close()
+    
+    def close(self):
+        """
+        Closes every handle, the threads must be done reading.
+        """
+        with self.lock:
+            handles, self.handles = self.handles, set()
+        for f in handles:
+            f.close()
+
+class PieceCache(object):
+    """
+    Remembers the hashes of pieces read from local files, across runs.
+    
+    A piece is identified by the device, inode, size and modification time of the file
+    together with its offset and length, so pieces of changed files are not found.
+    The cache is only an optimization, errors using it are logged and ignored.
+    """
+    commit_every = 1000 # number of new hashes between commits
+    
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.uncommitted = 0
+        self.connection = None
+        if sqlite3 is None:
+            logger.warning('sqlite3 is not available, not caching piece hashes')
+            return
+        
+        try:
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS pieces (dev INTEGER, ino INTEGER, size INTEGER, mtime REAL, '
+                                    'offset INTEGER, length INTEGER, hash BLOB NOT NULL, PRIMARY KEY (dev, ino, size, mtime, offset, length))')
+            self.connection.commit()
+        except sqlite3.Error as e:
+            logger.warning('Unable to open piece cache %r: %s' % (path, e))
+            self.connection = None
+    
+    def get_key(self, file_path, offset, length):
+        """
+        Returns the key of a piece or None if the file cannot be stat'ed.
+        """
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return None
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime, offset, length)
+    
+    def get(self, key):
+        if self.connection is None or key is None:
+            return None
         
+        with self.lock:
+            try:
+                row = self.connection.execute('SELECT hash FROM pieces WHERE dev = ? AND ino = ? AND size = ? AND mtime = ? '
+                                              'AND offset = ? AND length = ?', key).fetchone()
+            except sqlite3.Error as e:
+                logger.debug('Failed to read from piece cache: %s', e)
+                return None
         
-        return p
+        return row and bytes(row[0]) or None
+    
+    def set(self, key, digest):
+        if self.connection is None or key is None:
+            return
+        
+        with self.lock:
+            try:
+                self.connection.execute('INSERT OR REPLACE INTO pieces (dev, ino, size, mtime, offset, length, hash) '
+                                        'VALUES (?, ?, ?, ?, ?, ?, ?)', key + (sqlite3.Binary(digest), ))
+                self.uncommitted += 1
+                if self.uncommitted >= self.commit_every:
+                    self._commit()
+            except sqlite3.Error as e:
+                logger.debug('Failed to write to piece cache: %s', e)
+    
+    def _commit(self):
+        self.connection.commit()
+        self.uncommitted = 0
+    
+    def sync(self):
+        """
+        Commits the hashes added, so other runs can use them.
+        """
+        if self.connection is None:
+            return
+        
+        with self.lock:
+            try:
+                self._commit()
+            except sqlite3.Error as e:
+                logger.debug('Failed to commit piece cache: %s', e)
 
 class Pieces(object):
     """
     Can help check if files match the files found in a torrent.
     """
     
-    def __init__(self, torrent):
+    def __init__(self, torrent, executor=None, prefetch=1, cache=None):
+        """
+        executor is used to hash pieces concurrently, without it they are hashed one by one.
+        prefetch is the number of pieces given to the executor at a time.
+        cache is a PieceCache asked before reading a piece.
+        """
         self.piece_size = torrent[b'info'][b'piece length']
+        pieces = torrent[b'info'][b'pieces']
         self.pieces = []
-        for i in range(0, len(torrent[b'info'][b'pieces']), 20):
-            self.pieces.append(torrent[b'info'][b'pieces'][i:i+20])
+        for i in range(0, len(pieces), 20):
+            piece = pieces[i:i+20]
+            if isinstance(piece, memoryview): # the decoder does not copy the pieces
+                piece = piece.tobytes()
+            self.pieces.append(piece)
+        
+        self.executor = executor
+        self.prefetch = prefetch
+        self.cache = cache
+        self.pieces_verified = 0
+        self.open_files = None # the files kept open while pieces are hashed by _hash_all
+        self.runs = 0
     
     def get_complete_pieces(self, start_size, end_size):
         """
@@ -88,9 +271,196 @@ class Pieces(object):
         logger.debug('Start piece:%i end piece:%i' % (start_piece, end_piece-1))
         return start_offset, end_offset, self.pieces[start_piece:end_piece]
     
+    def hash_piece(self, file_path, offset):
+        """
+        Returns the sha1 digest of the piece found at offset in file_path,
+        None if the offset is before the start of the file.
+        """
+        if offset < 0:
+            return None
+        
+        if self.cache is not None:
+            key = self.cache.get_key(file_path, offset, self.piece_size)
+            digest = self.cache.get(key)
+            if digest is not None:
+                return digest
+        
+        piece = get_buffer(self.piece_size)
+        read = self._read_into(piece, file_path, offset)
+        
+        digest = hashlib.sha1(piece[:read]).digest()
+        if self.cache is not None:
+            self.cache.set(key, digest)
+        return digest
+    
+    def _read_into(self, buffer, file_path, offset):
+        """
+        Reads from offset in file_path until buffer is full or the file ends, returns the number of bytes read.
+        """
+        if self.open_files is None:
+            with io.open(file_path, 'rb', buffering=0) as f:
+                return self._read_from(f, buffer, offset)
+        return self._read_from(self.open_files.open(file_path), buffer, offset)
+    
+    def _read_from(self, f, buffer, offset):
+        read = 0
+        f.seek(offset)
+        while read < len(buffer):
+            count = f.readinto(buffer[read:])
+            if not count:
+                break
+            read += count
+        return read
+    
+    def hash_piece_parts(self, parts):
+        """
+        Returns the sha1 digest of a piece assembled from parts, a list of (file_path, offset, length).
+        """
+        if len(parts) == 1 and parts[0][2] == self.piece_size:
+            return self.hash_piece(*parts[0][:2])
+        
+        piece = get_buffer(self.piece_size)
+        read = 0
+        for file_path, offset, length in parts:
+            count = self._read_into(piece[read:read+length], file_path, offset)
+            read += count
+            if count < length: # the file is shorter than expected, the piece cannot match
+                break
+        
+        return hashlib.sha1(piece[:read]).digest()
+    
+    def _hash_all(self, function, items):
+        """
+        Calls function with every tuple of arguments in items and yields the results in order.
+        
+        With an executor, the following items are hashed while the current one is used.
+        The items not used yet are cancelled when the generator is closed.
+        
+        The files read stay open until the last running generator is done.
+        """
+        if self.open_files is None:
+            self.open_files = OpenFiles()
+        self.runs += 1
+        
+        queue = deque()
+        try:
+            if self.executor is None:
+                for args in items:
+                    yield function(*args)
+                return
+            
+            items = iter(items)
+            while True:
+                for args in islice(items, self.prefetch - len(queue)):
+                    queue.append(self.executor.submit(function, *args))
+                
+                if not queue:
+                    break
+                
+                yield queue.popleft().result()
+        finally:
+            for future in queue:
+                future.cancel()
+            wait(queue) # the items already started still read from the open files
+            
+            self.runs -= 1
+            if not self.runs:
+                self.open_files.close()
+                self.open_files = None
+    
+    def hash_pieces(self, pieces):
+        """
+        Hashes pieces, an iterable of (file_path, offset), and yields the digests in order.
+        """
+        return self._hash_all(self.hash_piece, pieces)
+    
+    def get_piece_parts(self, files):
+        """
+        Assembles the pieces of a torrent from its files, a list of (file_path, length) in the
+        order of the torrent where file_path is None for files not found.
+        
+        Yields (piece, parts) for every piece where all the files are found, parts is a list of
+        (file_path, offset, length) that make up the piece, spanning files when needed.
+        """
+        piece, parts, used, missing = 0, [], 0, False
+        for file_path, length in files:
+            offset = 0
+            while offset < length:
+                count = min(self.piece_size - used, length - offset)
+                if file_path is None:
+                    missing = True
+                else:
+                    parts.append((file_path, offset, count))
+                offset += count
+                used += count
+                
+                if used == self.piece_size:
+                    if not missing:
+                        yield piece, parts
+                    piece, parts, used, missing = piece + 1, [], 0, False
+        
+        if used and not missing:
+            yield piece, parts
+    
     def find_piece_breakpoint(self, file_path, start_size, end_size):
         """
         Finds the point where a file with a different size is modified and tries to align it with pieces.
+        
+        The modification is bisected from both ends of the file, if that does not look like
+        a single modification, all the pieces are scanned from the start.
+        """
+        breakingpoint = self.bisect_piece_breakpoint(file_path, start_size, end_size)
+        if breakingpoint is None:
+            logger.debug('Bisecting did not find a single modification, scanning the pieces')
+            breakingpoint = self.scan_piece_breakpoint(file_path, start_size, end_size)
+        return breakingpoint
+    
+    def bisect_piece_breakpoint(self, file_path, start_size, end_size):
+        """
+        Finds the breakpoint like scan_piece_breakpoint, assuming the file has one modified region.
+        
+        The last piece matching from the start and the last piece matching from the end are found by bisecting.
+        Returns None if the pieces between them cannot be explained by the size difference.
+        """
+        start_offset, end_offset, pieces = self.get_complete_pieces(start_size, end_size)
+        size = os.path.getsize(file_path)
+        
+        def last_match(matches):
+            """
+            Returns the index of the last piece matching before the first piece not matching, -1 if none match.
+            """
+            if not pieces or not matches(0):
+                return -1
+            
+            low, high = 0, len(pieces) - 1
+            if matches(high):
+                return high
+            
+            while high - low > 1:
+                middle = (low + high) // 2
+                if matches(middle):
+                    low = middle
+                else:
+                    high = middle
+            return low
+        
+        start_match = last_match(lambda i: self.hash_piece(file_path, start_offset+self.piece_size*i) == pieces[i])
+        if start_match < 0:
+            return None
+        
+        if start_match < len(pieces) - 1:
+            end_match = last_match(lambda i: self.hash_piece(file_path, size-end_offset-self.piece_size*(i+1)) == pieces[(i+1)*-1])
+            unmatched_pieces = len(pieces) - (start_match + 1) - (end_match + 1)
+            if unmatched_pieces > abs(size - (end_size - start_size)) // self.piece_size + 2:
+                return None
+        
+        breakingpoint = start_offset + self.piece_size*start_match
+        logger.debug('Bisected %i pieces to be ok, so we set breakingpoint at %i' % (start_match, breakingpoint))
+        return breakingpoint
+    
+    def scan_piece_breakpoint(self, file_path, start_size, end_size):
+        """
+        Finds the breakpoint by hashing the pieces from the start until too many fail.
         """
         start_offset, end_offset, pieces = self.get_complete_pieces(start_size, end_size)
         
@@ -98,24 +468,25 @@ class Pieces(object):
         success_count = failed_pieces
         piece_status = []
         
-        with open(file_path, 'rb') as f:
-            f.seek(start_offset)
-            for i, piece in enumerate(pieces):
-                logger.debug('Checking piece %i for breakingpoint' % (i, ))
-                h = hashlib.sha1(f.read(self.piece_size)).digest()
+        hashes = self.hash_pieces((file_path, start_offset + self.piece_size*i) for i in range(len(pieces)))
+        try:
+            for i, (piece, h) in enumerate(zip(pieces, hashes)):
+                logger.debug('Checking piece %i for breakingpoint', i)
                 if h == piece:
-                    logger.debug('Piece %i matched' % i)
+                    logger.debug('Piece %i matched', i)
                     if success_count < failed_pieces:
                         success_count += 1
                     piece_status.append(True)
                 else:
-                    logger.debug('Piece %i did not match' % i)
+                    logger.debug('Piece %i did not match', i)
                     success_count -= 1
                     piece_status.append(False)
                 
                 if success_count <= 0:
                     logger.debug('The breakingpoint has been found after piece %i - more than %i failed pieces' % (i, failed_pieces))
                     break
+        finally:
+            hashes.close()
         
         for p in piece_status[::-1]:
             if p:
@@ -126,54 +497,197 @@ class Pieces(object):
         logger.debug('A total of %i pieces were ok, so we set breakingpoint at %i' % (i, breakingpoint))
         return breakingpoint
 
+    def get_match_limits(self, count):
+        """
+        Returns (check_pieces, must_match) used by match_files for a file with count whole pieces,
+        the number of pieces checked from each end and how many of them can fail.
+        """
+        check_pieces = (count // 10) or 1
+        
+        if check_pieces < 4:
+            must_match = 1
+        elif check_pieces < 10:
+            must_match = 2
+        else:
+            must_match = max(check_pieces // 10, 3)
+        
+        return check_pieces, must_match
+    
+    def precheck_files(self, file_paths, start_size, end_size):
+        """
+        A cheap check to do before match_files. The first whole piece from the start of every file is hashed,
+        the files where it does not match are checked from both ends until match_files cannot accept them.
+        
+        Returns the files match_files can accept, in the order of file_paths.
+        """
+        file_paths = list(file_paths)
+        start_offset, end_offset, pieces = self.get_complete_pieces(start_size, end_size)
+        if not pieces:
+            return []
+        
+        check_pieces, must_match = self.get_match_limits(len(pieces))
+        failing = min(must_match + 1, check_pieces) # pieces failing from one end that match_files does not accept
+        
+        matched = set()
+        hashes = self.hash_pieces((file_path, start_offset) for file_path in file_paths)
+        try:
+            for file_path in file_paths:
+                if next(hashes) == pieces[0]:
+                    matched.add(file_path)
+        finally:
+            hashes.close()
+        
+        unmatched = [file_path for file_path in file_paths if file_path not in matched]
+        
+        def piece_offsets():
+            for file_path in unmatched:
+                size = os.path.getsize(file_path)
+                for i in range(1, failing):
+                    yield file_path, start_offset+self.piece_size*i
+                
+                for i in range(failing):
+                    yield file_path, size-end_offset-self.piece_size*(i+1)
+        
+        hashes = self.hash_pieces(piece_offsets())
+        try:
+            for file_path in unmatched:
+                start_hashes = [next(hashes) for i in range(1, failing)]
+                end_hashes = [next(hashes) for i in range(failing)]
+                if any(h == pieces[i] for i, h in enumerate(start_hashes, 1)) or \
+                   any(h == pieces[(i+1)*-1] for i, h in enumerate(end_hashes)):
+                    matched.add(file_path)
+                else:
+                    logger.debug('First pieces of %r did not match, skipping it', file_path)
+        finally:
+            hashes.close()
+        
+        return [file_path for file_path in file_paths if file_path in matched]
+    
     def match_file(self, file_path, start_size, end_size):
         """
         Try to match file starting at start_size and ending at end_size.
         """
+        for _, result in self.match_files([file_path], start_size, end_size):
+            return result
+    
+    def match_files(self, file_paths, start_size, end_size):
+        """
+        Try to match the files in file_paths, one after another, to the part of the torrent
+        starting at start_size and ending at end_size.
+        
+        Yields tuples of (file_path, (match_start, match_end)) in the order of file_paths.
+        With an executor, the pieces of the next files are hashed while a file is matched.
+        """
+        file_paths = list(file_paths)
         start_offset, end_offset, pieces = self.get_complete_pieces(start_size, end_size)
         logger.debug('Stuff to check start_offset:%i end_offset:%i pieces:%s' % (start_offset, end_offset, len(pieces)))
         if not pieces:
-            logger.debug('No whole pieces found for %r, taking this as a not-match' % file_path)
-            return False, False
+            for file_path in file_paths:
+                logger.debug('No whole pieces found for %r, taking this as a not-match' % file_path)
+                yield file_path, (False, False)
+            return
         
-        check_pieces = (len(pieces) // 10) or 1
+        check_pieces, must_match = self.get_match_limits(len(pieces))
         
-        match_start, match_end = 0, 0
-        size = os.path.getsize(file_path)
-        with open(file_path, 'rb') as f:
-            for i in range(check_pieces): # check from beginning
-                seek_offset = start_offset+self.piece_size*i
-                logger.debug('Checking piece %i from beginning of file, reading from %i bytes. Filesize: %i' % (i, seek_offset, size))
-                f.seek(seek_offset)
-                h = hashlib.sha1(f.read(self.piece_size)).digest()
-                logger.debug('Matching hash %r against %r' % (h, pieces[i]))
-                if h == pieces[i]:
-                    logger.debug('Piece %i matched' % i)
-                    match_start += 1
-                else:
-                    logger.debug('Piece %i did not match' % i)
-            
-            for i in range(check_pieces): # check from end
-                seek_offset = size-end_offset-self.piece_size*(i+1)
-                logger.debug('Checking piece %i from end of file, reading from %i bytes. Filesize: %i' % (i, seek_offset, size))
-                f.seek(seek_offset)
-                h = hashlib.sha1(f.read(self.piece_size)).digest()
-                piece = pieces[(i+1)*-1]
-                logger.debug('Matching hash %r against %r' % (h, piece))
-                if h == piece:
-                    logger.debug('Piece %i matched' % i)
-                    match_end += 1
-                else:
-                    logger.debug('Piece %i did not match' % i)
+        def piece_offsets():
+            for file_path in file_paths:
+                size = os.path.getsize(file_path)
+                for i in range(check_pieces): # check from beginning
+                    yield file_path, start_offset+self.piece_size*i
+                
+                for i in range(check_pieces): # check from end
+                    yield file_path, size-end_offset-self.piece_size*(i+1)
         
-        logger.debug('Checked %i pieces from both start and end. %i matched from start and %i matched from end.' % (check_pieces, match_start, match_end))
+        hashes = self.hash_pieces(piece_offsets())
+        try:
+            for file_path in file_paths:
+                match_start, match_end = 0, 0
+                for i in range(check_pieces):
+                    if next(hashes) == pieces[i]:
+                        logger.debug('Piece %i from beginning of %r matched', i, file_path)
+                        match_start += 1
+                
+                for i in range(check_pieces):
+                    if next(hashes) == pieces[(i+1)*-1]:
+                        logger.debug('Piece %i from end of %r matched', i, file_path)
+                        match_end += 1
+                
+                logger.debug('Checked %i pieces from both start and end. %i matched from start and %i matched from end.' % (check_pieces, match_start, match_end))
+                
+                yield file_path, (match_start and check_pieces - match_start <= must_match,
+                                  match_end and check_pieces - match_end <= must_match)
+        finally:
+            hashes.close()
+    
+    def verify_files(self, files, ratio=1.0, limit=None):
+        """
+        Checks that the files found contain the pieces of the torrent, files is a list of
+        (file_path, length) in the order of the torrent where file_path is None for files not found.
+        Pieces spanning several files are assembled from all of them.
         
-        if check_pieces < 4:
-            must_match = 1
-        elif check_pieces < 10:
-            must_match = 2
-        else:
-            must_match = max(check_pieces // 10, 3)
+        ratio is the part of the pieces checked in each file, at least the first and the last
+        piece are checked and the rest are spread evenly between them.
+        limit is the max number of pieces checked, the first and last pieces of the files come first
+        and the rest are taken from every file in turn. The pieces checked are counted in pieces_verified.
+        
+        Returns the file paths where a checked piece did not match, in the order of files.
+        A piece that did not match fails all the files it spans.
+        """
+        pieces = list(self.get_piece_parts(files))
+        file_pieces = {}
+        for i, (_, parts) in enumerate(pieces):
+            for file_path, _, _ in parts:
+                file_pieces.setdefault(file_path, []).append(i)
+        
+        file_samples = []
+        for file_path, _ in files:
+            indexes = file_pieces.pop(file_path, None)
+            if not indexes:
+                continue
+            count = len(indexes)
+            samples = min(max(int(count * ratio + 0.5), 2), count)
+            samples = [indexes[(i * (count - 1)) // max(samples - 1, 1)] for i in range(samples)]
+            file_samples.append(samples[:1] + samples[-1:] + samples[1:-1])
+        
+        selected = set()
+        for samples in zip_longest(*file_samples): # a sample of every file at a time
+            for piece in samples:
+                if piece is not None and (limit is None or len(selected) < limit):
+                    selected.add(piece)
+        
+        checks = [pieces[i] for i in sorted(selected)] # in order, so files are read sequentially
+        logger.debug('Verifying %i of %i pieces found', len(checks), len(pieces))
+        self.pieces_verified += len(checks)
+        
+        failed = set()
+        matched = self._match_piece_parts(checks)
+        for piece, parts in checks:
+            if piece not in matched:
+                logger.debug('Piece %i did not match, it spans %r', piece, [p[0] for p in parts])
+                failed.update(p[0] for p in parts)
+        
+        return [file_path for file_path, _ in files if file_path in failed]
+    
+    def match_pieces(self, files, indexes):
+        """
+        Hashes the pieces in indexes, assembled from files like get_piece_parts does,
+        and returns the set of the indexes where the piece matched the torrent.
+        Pieces spanning a file not found are not hashed and do not match.
+        """
+        indexes = set(indexes)
+        return self._match_piece_parts([(piece, parts) for piece, parts in self.get_piece_parts(files) if piece in indexes])
+    
+    def _match_piece_parts(self, checks):
+        """
+        Hashes the pieces in checks, a list of (piece, parts), and returns the set of the pieces that matched.
+        """
+        matched = set()
+        hashes = self._hash_all(self.hash_piece_parts, ((parts, ) for _, parts in checks))
+        try:
+            for piece, parts in checks:
+                if next(hashes) == self.pieces[piece]:
+                    matched.add(piece)
+        finally:
+            hashes.close()
         
-        return (match_start and check_pieces - match_start <= must_match,
-                match_end and check_pieces - match_end <= must_match)
+        return matched
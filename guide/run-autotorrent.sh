@@ -12,7 +12,7 @@ flexget_command="~/flexget/bin/flexget execute --tasks sse isl"
 # We need to prevent all database access while rescanning
 if [ "$1" = "rescan" ]; then
     sleep 1 # make sure deluge finished moving data before rescanning
-    flock -x ./autotorrent.lock autotorrent-env/bin/autotorrent -r # flock to prevent multiple rescans
+    flock -x ./autotorrent.lock autotorrent-env/bin/autotorrent -r -i # flock to prevent multiple rescans, -i only rescans changed folders
     eval $flexget_command # It might be smart to execute flexget when we know there might be.
 fi
 
@@ -20,8 +20,8 @@ setup(
     author_email='johndoee+autotorrent@tidalstream.org',
     maintainer='John Doee',
     url='https://github.com/JohnDoee/autotorrent',
-    packages=['autotorrent', 'autotorrent.clients'],
-    install_requires=['six', 'deluge-client', 'requests'],
+    packages=['autotorrent', 'autotorrent.clients', 'autotorrent.storage'],
+    install_requires=['six', 'deluge-client', 'requests', 'futures; python_version < "3.0"', 'scandir; python_version < "3.5"'],
     license='MIT',
     package_data={'autotorrent': ['autotorrent.conf.dist']},
     classifiers=[